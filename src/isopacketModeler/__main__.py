@@ -5,20 +5,30 @@ Created on Thu Mar 28 17:09:56 2024
 
 @author: 4vt
 """
+import time
+start = time.perf_counter()
 from isopacketModeler.options import options
 args = options()
 
-from isopacketModeler.parse_mzml import parse_PSMs, initialize_psms, process_spectrum_data
-from isopacketModeler.make_peptides import initialize_peptides
-from isopacketModeler.classifier_tools import classifier
+import sys
+from isopacketModeler.make_peptides import initialize_peptides, shard_peptides
 from isopacketModeler.fit_controller import peptide_fit_conroller
-from isopacketModeler.report import make_report
+from isopacketModeler.report import make_report, dump_shard, merge_shards, ReportWriter
 from isopacketModeler.checkpoint import Checkpointer
+#the mzML parser and PSM classifier are imported by the steps that use them
+args.logs.debug(f'Startup took {time.perf_counter() - start:.2f} seconds.')
+
+#Combine the output of sharded model fitting.
+if args.merge_shards:
+    peptides = merge_shards(args)
+    make_report(args, peptides)
+    sys.exit(0)
 
 checkpointer = Checkpointer(args)
 
 #Collect data from mzML files.
 if checkpointer.load_step < 1:
+    from isopacketModeler.parse_mzml import parse_PSMs, initialize_psms, process_spectrum_data
     psm_data = parse_PSMs(args)
     psms = initialize_psms(args, psm_data)
     psms = process_spectrum_data(args, psms)
@@ -30,9 +40,15 @@ elif checkpointer.load_step == 1:
 if checkpointer.load_step < 2:
     bad_psms = []
     if args.do_psm_classification:
+        from isopacketModeler.classifier_tools import classifier
         psm_classifier = classifier(args)
         psm_data, psm_labels = psm_classifier.preprocess(psms)
-        psm_classifier.fit(psm_data, psm_labels)
+        if args.classifier_model:
+            #a previously trained model only needs to run inference
+            psm_classifier.load(args.classifier_model)
+        else:
+            psm_classifier.fit(psm_data, psm_labels)
+            psm_classifier.save(f'{args.output_directory}psm_classifier/')
         psms, bad_psms = psm_classifier.winnow(psm_data, psms)
     
     #Collect PSMs into peptide objects.
@@ -42,9 +58,16 @@ elif checkpointer.load_step == 2:
     peptides = checkpointer.data
 
 #Fit models to peptide data.
+if args.shard:
+    peptides = shard_peptides(args, peptides)
 fit_controller = peptide_fit_conroller(args)
-peptides = fit_controller.fit_peptides(peptides)
+#report rows are written as peptides are finished
+writer = None if args.shard else ReportWriter(args)
+peptides = fit_controller.fit_peptides(peptides, checkpointer.fit_store, prune = not args.shard, writer = writer)
 
 #Export results.
-make_report(args, peptides)
+if args.shard:
+    dump_shard(args, peptides)
+else:
+    make_report(args, peptides, writer)
 
@@ -9,6 +9,51 @@ import os
 import sys
 import dill
 import glob
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import numpy as np
+
+from isopacketModeler.data_objects import PSMTable, peptide
+
+class FitStore:
+    """
+    An append-only file of model fits keyed by peptide fingerprint and model name.
+    Fits are written as they finish so that an interrupted step 3 can be resumed.
+    """
+    def __init__(self, path, logs, resume):
+        self.path = path
+        self.logs = logs
+        self.fits = {}
+        if resume and os.path.exists(path):
+            self.load()
+        else:
+            open(self.path, 'wb').close()
+    
+    def load(self):
+        end = 0
+        with open(self.path, 'rb') as dillfile:
+            while True:
+                try:
+                    key, name, result = dill.load(dillfile)
+                except Exception:
+                    #either the end of the file or a record cut short by the interruption
+                    break
+                self.fits.setdefault(key, {})[name] = result
+                end = dillfile.tell()
+        #drop any partial record so that new records are appended after the last complete one
+        os.truncate(self.path, end)
+        self.logs.debug(f'Loaded {sum(len(f) for f in self.fits.values())} model fits from {self.path}.')
+    
+    def get(self, key):
+        return dict(self.fits.get(key, {}))
+    
+    def append(self, key, name, result):
+        self.fits.setdefault(key, {})[name] = result
+        with open(self.path, 'ab') as dillfile:
+            dill.dump((key, name, result), dillfile)
 
 class Checkpointer:
     def __init__(self, options):
@@ -21,32 +66,95 @@ class Checkpointer:
                 self.checkpoints.extend(glob.glob(file))
             else:
                 self.checkpoints.append(file)
+        #legacy dill checkpoints have to be read to find their step
+        self.legacy = {}
         if self.checkpoints:
-            self.load_step, self.data = self.load()
-            self.logs.info(f'Loaded checkpoint for step {self.load_step}.')
+            self.load_step = self.validate()
+            if options.stream_checkpoints and self.load_step == 2:
+                #peptides from each file are handed to model fitting as soon as they are loaded
+                self.data = self.iter_load(options.cores)
+                self.logs.info(f'Streaming checkpoint for step 2 from {len(self.checkpoints)} files.')
+            else:
+                self.data = [d for data in self.iter_load(options.cores) for d in data]
+                self.logs.info(f'Loaded checkpoint for step {self.load_step}.')
         else:
             self.load_step = 0
             self.data = None
-        
-    def load(self):
+        #fits from an earlier run are only reused when that run's peptides are being resumed
+        shard = f'_shard{options.shard[0]}of{options.shard[1]}' if options.shard else ''
+        self.fit_store = FitStore(f'{self.output_directory}checkpoint_step3_fits{shard}.dill', 
+                                  self.logs, 
+                                  resume = self.load_step == 2)
+    
+    def validate(self):
+        #the step of every checkpoint is checked before any data are loaded
         steps = set()
-        data = []
-        for checkpoint_file in self.checkpoints:
-            self.logs.debug(f'Now loading checkpoint file {checkpoint_file}')
-            with open(checkpoint_file, 'rb') as dillfile:
-                step, data_tmp = dill.load(dillfile)
-            data.extend(data_tmp)
-            steps.add(step)
-            if len(steps) > 1:
-                self.logs.error('Checkpoints from multiple steps detected. Please only load checkpoints from one step.')
-                sys.exit(1)
-        return next(s for s in steps), data
+        for checkpoint in self.checkpoints:
+            if os.path.isdir(checkpoint):
+                header_file = os.path.join(checkpoint, 'header.json')
+                if not os.path.exists(header_file):
+                    self.logs.error(f'Checkpoint {checkpoint} has no header, it was not completely written.')
+                    sys.exit(1)
+                with open(header_file, 'r') as header:
+                    steps.add(json.load(header)['step'])
+            else:
+                #checkpoints written by older versions are a single dill file
+                with open(checkpoint, 'rb') as dillfile:
+                    self.legacy[checkpoint] = dill.load(dillfile)
+                steps.add(self.legacy[checkpoint][0])
+        if len(steps) > 1:
+            self.logs.error('Checkpoints from multiple steps detected. Please only load checkpoints from one step.')
+            sys.exit(1)
+        return next(s for s in steps)
+        
+    def load_checkpoint(self, checkpoint):
+        if checkpoint in self.legacy:
+            return self.legacy.pop(checkpoint)[1]
+        psms = PSMTable.load(checkpoint).to_psms()
+        if self.load_step == 1:
+            return psms
+        offsets = np.load(os.path.join(checkpoint, 'peptide_offsets.npy'))
+        return [peptide(psms[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    
+    def iter_load(self, cores):
+        """
+        Load the checkpoint files in parallel and yield the data of each file, in order, as it is ready.
+        At most cores files are loading or waiting to be consumed at once so that memory use stays bounded.
+        """
+        cores = max(1, cores)
+        with ThreadPoolExecutor(max_workers = cores) as pool:
+            pending = deque()
+            for checkpoint in self.checkpoints:
+                pending.append((checkpoint, pool.submit(self.load_checkpoint, checkpoint)))
+                if len(pending) == cores:
+                    yield self.loaded(*pending.popleft())
+            while pending:
+                yield self.loaded(*pending.popleft())
+    
+    def loaded(self, checkpoint, future):
+        data = future.result()
+        self.logs.debug(f'Loaded checkpoint file {checkpoint}')
+        return data
     
     def dump(self, data, step):
-        checkpoint_file = f'{self.output_directory}checkpoint_step{step}_{str(hash(str(data))%9999) + str(os.getpid())}.dill'
-        with open(checkpoint_file, 'wb') as dillfile:
-                dill.dump((step, data), dillfile)
-        self.logs.info(f'Saved checkpoint for step {step} in file {checkpoint_file}.')
+        """
+        Save a checkpoint directory holding the PSMs as a PSMTable. 
+        Step 2 checkpoints also record which PSMs make up each peptide.
+        The header is written last so that only complete checkpoints can be loaded.
+        """
+        checkpoint = f'{self.output_directory}checkpoint_step{step}_{uuid.uuid4().hex[:12]}/'
+        if step == 1:
+            psms = data
+        else:
+            psms = [p for pep in data for p in pep.psms]
+        PSMTable.from_psms(psms).save(checkpoint)
+        header = {'step':step, 'psms':len(psms)}
+        if step == 2:
+            np.save(f'{checkpoint}peptide_offsets.npy', np.cumsum([0] + [len(pep.psms) for pep in data], dtype = np.int64))
+            header['peptides'] = len(data)
+        with open(f'{checkpoint}header.json', 'w') as header_file:
+            json.dump(header, header_file)
+        self.logs.info(f'Saved checkpoint for step {step} in {checkpoint}.')
         
         if self.stopping_point == step:
             self.logs.info(f'Now stopping at checkpoint step {step}.')
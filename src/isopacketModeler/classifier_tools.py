@@ -7,31 +7,85 @@ Created on Tue Mar 12 13:29:55 2024
 """
 from copy import copy
 from collections import defaultdict, Counter
+from functools import cache
+import json
+from concurrent.futures import ThreadPoolExecutor
 import os
 import logging
 
 import numpy as np
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-logging.getLogger('tensorflow').setLevel(logging.ERROR)
-os.environ["KMP_AFFINITY"] = "noverbose"
-import tensorflow as tf
-tf.autograph.set_verbosity(3)
-from tensorflow.keras import layers, models
-tf.config.set_visible_devices([], 'GPU')
+
+def pad(arrays, width):
+    """A (len(arrays) x width) matrix of the arrays left aligned and padded with NaN."""
+    lengths = np.array([len(a) for a in arrays], dtype = np.int64)
+    matrix = np.full((len(arrays), width), np.nan)
+    matrix[np.arange(width)[np.newaxis, :] < lengths[:, np.newaxis]] = np.concatenate([np.asarray(a, dtype = float) for a in arrays])
+    return matrix
+
+def interpolate(xp, fps, num = 256):
+    """
+    Row-wise np.interp of each matrix in fps onto num evenly spaced points spanning each row of xp. 
+    Rows are NaN padded on the right and the arithmetic matches np.linspace and np.interp exactly.
+    """
+    start = np.nanmin(xp, axis = 1)[:, np.newaxis]
+    stop = np.nanmax(xp, axis = 1)[:, np.newaxis]
+    x = np.arange(num, dtype = float)[np.newaxis, :]*((stop - start)/(num - 1)) + start
+    x[:, -1:] = stop
+    
+    #index of the last point at or below each x, from a stable merge of the points and x
+    #ties sort the points first and the NaN padding is moved to the end
+    last = np.sum(~np.isnan(xp), axis = 1)[:, np.newaxis] - 1
+    merged = np.concatenate((np.where(np.isnan(xp), np.inf, xp), x), axis = 1)
+    is_x = np.argsort(merged, axis = 1, kind = 'stable') >= xp.shape[1]
+    j = np.cumsum(~is_x, axis = 1)[is_x].reshape(x.shape) - 1
+    exact = j == last
+    
+    #flat indices into the matrices are shared by every fp
+    rows = np.arange(xp.shape[0])[:, np.newaxis]*xp.shape[1]
+    j_next = np.minimum(j + 1, last) + rows
+    j = j + rows
+    x_j = xp.ravel()[j]
+    exact |= x_j == x
+    dx = xp.ravel()[j_next] - x_j
+    offset = x - x_j
+    results = []
+    for fp in fps:
+        f_j = fp.ravel()[j]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            interp = (fp.ravel()[j_next] - f_j)/dx*offset + f_j
+        interp[exact] = f_j[exact]
+        results.append(interp)
+    return results
+
+@cache
+def tensorflow():
+    #tensorflow is slow to import so it is only loaded when PSM classification runs
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    logging.getLogger('tensorflow').setLevel(logging.ERROR)
+    os.environ["KMP_AFFINITY"] = "noverbose"
+    import tensorflow as tf
+    tf.autograph.set_verbosity(3)
+    tf.config.set_visible_devices([], 'GPU')
+    return tf
 
 class classifier():
     def __init__(self, args):
         self.args = args
         self.FDR = args.classifier_fdr
+        self.tolerance = args.classifier_tolerance
+        self.patience = args.classifier_patience
         self.cutoff = np.nan
         self.rng = np.random.default_rng(1)
         self.history = defaultdict(lambda : [])
+        tf = tensorflow()
         tf.config.threading.set_intra_op_parallelism_threads(args.cores)
         tf.config.threading.set_inter_op_parallelism_threads(args.cores)
 
     def _get_model(self):
         if 'model' in self.__dict__.keys():
             del self.model
+        tf = tensorflow()
+        layers, models = tf.keras.layers, tf.keras.models
         model = models.Sequential()
         model.add(layers.Conv2D(5, (3, 2), activation='relu', input_shape=(256, 2, 1), padding='same'))
         model.add(layers.Dropout(0.1))
@@ -53,67 +107,119 @@ class classifier():
         return model
 
     def _fit_one_step(self, X, y, epochs = 7):
-        self.model = self._get_model()
-        history = self.model.fit(X, y.reshape((-1,1)), epochs=epochs)
+        #training continues from the current weights and stops once the validation loss stops improving
+        early_stopping = tensorflow().keras.callbacks.EarlyStopping(monitor = 'val_loss', 
+                                                                    patience = self.patience, 
+                                                                    restore_best_weights = True)
+        history = self.model.fit(X, y.reshape((-1,1)), epochs=epochs, validation_split = 0.1, callbacks = [early_stopping])
         for key in history.history:
             self.history[key].extend(history.history[key])
-        self.history['epochs'].append(epochs)
+        self.history['epochs'].append(len(history.history['loss']))
         return self
 
     def _set_cutoff(self, targets, decoys):
+        """
+        Finds the score cutoff for the target FDR. Observations are removed from the lowest score up, 
+        decoys first among ties, until the estimated FDR of the rest is at most the target. 
+        The q-value of a score is the lowest FDR of any of these cutoffs that it passes.
+        """
         ndecoy = len(decoys)
         ntarget = len(targets)
         decoy_scale = ntarget/ndecoy
-        ŷ = list(decoys) + list(targets)
-        y = [0]*ndecoy + [1]*ntarget
-        observations = sorted(zip(ŷ,y, strict = True), reverse = True)
-        exp_fdr = (ndecoy*decoy_scale)/ntarget
-        while exp_fdr > self.FDR:
-            elm = observations.pop()
-            if elm[1]:
-                ntarget -= 1
-            else:
-                ndecoy -= 1
-            exp_fdr = (ndecoy*decoy_scale)/ntarget if ntarget > 0 else 0
-        self.cutoff = elm[0]
+        scores = np.concatenate((decoys, targets))
+        labels = np.concatenate((np.zeros(ndecoy, dtype = bool), np.ones(ntarget, dtype = bool)))
+        order = np.lexsort((labels, scores))
+        scores = scores[order]
+        labels = labels[order]
+        
+        #estimated FDR after removing the first k+1 observations
+        ntargets = ntarget - np.cumsum(labels)
+        ndecoys = ndecoy - np.cumsum(~labels)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            exp_fdr = np.where(ntargets > 0, (ndecoys*decoy_scale)/ntargets, 0)
+        init_fdr = (ndecoy*decoy_scale)/ntarget
+        self.cutoff = -np.inf if init_fdr <= self.FDR else scores[np.argmax(exp_fdr <= self.FDR)]
+        
+        self.qvalue_scores = scores
+        self.qvalue_table = np.minimum.accumulate(np.concatenate(([init_fdr], exp_fdr)))
+        return self
     
-    def predict_proba(self, X):
-        return self.model.predict(X)
+    def qvalues(self, probs):
+        """The q-value of each score from the FDR control set used to set the cutoff."""
+        #a score passes every cutoff below it, i.e. the removal of all lower observations
+        return self.qvalue_table[np.searchsorted(self.qvalue_scores, probs, side = 'left')]
     
-    def predict(self, X):
-        probs = self.predict_proba(X)[:,0]
+    def predict_proba(self, X, batch_size = 1024):
+        return self.model.predict(X, batch_size = batch_size)
+    
+    def predict(self, X, probs = None):
+        if probs is None:
+            probs = self.predict_proba(X)[:,0]
         return probs > self.cutoff
     
+    def save(self, directory):
+        """Write the trained model and its FDR cutoff to directory so that later runs can skip training."""
+        os.makedirs(directory, exist_ok = True)
+        self.model.save(os.path.join(directory, 'model.keras'))
+        with open(os.path.join(directory, 'classifier.json'), 'w') as jsonfile:
+            json.dump({'cutoff':float(self.cutoff), 'classifier_fdr':self.FDR}, jsonfile)
+        np.save(os.path.join(directory, 'qvalue_scores.npy'), self.qvalue_scores)
+        np.save(os.path.join(directory, 'qvalue_table.npy'), self.qvalue_table)
+        self.args.logs.info(f'The classifier model has been saved to {directory}')
+        return self
+    
+    def load(self, directory):
+        """Read a model written by save(), the loaded model is only used for prediction."""
+        with open(os.path.join(directory, 'classifier.json'), 'r') as jsonfile:
+            header = json.load(jsonfile)
+        self.model = tensorflow().keras.models.load_model(os.path.join(directory, 'model.keras'), compile = False)
+        self.cutoff = header['cutoff']
+        self.qvalue_scores = np.load(os.path.join(directory, 'qvalue_scores.npy'))
+        self.qvalue_table = np.load(os.path.join(directory, 'qvalue_table.npy'))
+        if header['classifier_fdr'] != self.FDR:
+            self.args.logs.warning(f'The classifier model in {directory} was trained with an FDR of {header["classifier_fdr"]}, its cutoff is used instead of one for {self.FDR}.')
+        self.args.logs.info(f'The classifier model has been loaded from {directory}')
+        return self
+    
     def winnow(self, X, psms):
-        classes = self.predict(X)
+        probs = self.predict_proba(X)[:,0]
+        classes = self.predict(X, probs)
+        #q-values are reported with the other PSM metadata, the dictionaries can be shared by duplicated controls
+        for psm, qvalue in zip(psms, self.qvalues(probs), strict = True):
+            psm.psm_metadata = {**psm.psm_metadata, 'classifier_qvalue':float(qvalue)}
         good_psms = [p for p,c in zip(psms, classes, strict = True) if c == 1 and p.is_labeled]
         bad_psms = [p for p,c in zip(psms, classes, strict = True) if c != 1 and p.is_labeled]
         self.args.logs.info(f'{len(good_psms)} PSMs have passed the classifier model filter.')
         return (good_psms, bad_psms)
 
-    def preprocess(self, psms):
-        data = []
-        for psm in psms:
-            intensity = copy(psm.intensity)
-            intensity = intensity/np.nanmax(intensity)
-            intensity[np.isnan(intensity)] = np.zeros(intensity.shape)[np.isnan(intensity)]
-            mz_err = copy(psm.mz_err)
-            mz_err = (mz_err/psm.mz)*1e5
-            mz_err[np.isnan(mz_err)] = np.full(mz_err.shape,-1)[np.isnan(mz_err)]
-            x = np.linspace(np.nanmin(psm.mz),np.nanmax(psm.mz),256)
-            interp_i = np.interp(x, psm.mz, intensity)
-            interp_i = interp_i/np.nansum(interp_i)
-            interp_mz = np.interp(x, psm.mz, mz_err)
-            interp_mz = interp_mz/np.nansum(interp_mz)
-            data.append(np.concatenate((interp_i[np.newaxis,:,np.newaxis],interp_mz[np.newaxis,:,np.newaxis]), axis = 2))
-        data = np.concatenate(data, axis = 0)
+    def preprocess(self, psms, chunk_size = 256):
+        """
+        Builds the (PSMs x 256 x 2) classifier input of each PSM's intensities and m/z errors interpolated 
+        onto 256 evenly spaced m/z values. PSMs are padded into matrices and processed in chunks.
+        """
+        width = max((len(psm.mz) for psm in psms), default = 0)
+        intensity = pad([psm.intensity for psm in psms], width)
+        intensity = intensity/np.nanmax(intensity, axis = 1)[:, np.newaxis]
+        intensity[np.isnan(intensity)] = 0
+        mz = pad([psm.mz for psm in psms], width)
+        mz_err = (pad([psm.mz_err for psm in psms], width)/mz)*1e5
+        mz_err[np.isnan(mz_err)] = -1
+        
+        data = np.empty((len(psms), 256, 2))
+        def process_chunk(start):
+            chunk = slice(start, start + chunk_size)
+            for i, interp in enumerate(interpolate(mz[chunk], (intensity[chunk], mz_err[chunk]))):
+                data[chunk, :, i] = interp/np.nansum(interp, axis = 1)[:, np.newaxis]
+        with ThreadPoolExecutor(self.args.cores) as pool:
+            list(pool.map(process_chunk, range(0, len(psms), chunk_size)))
         labels = np.array([psm.is_labeled for psm in psms])
         return (data, labels)
     
-    def _update_y(self, X, y_init, y_current):
+    def _update_y(self, X, y_init):
         ŷ = self.predict_proba(X)[:,0]
+        #degenerate predictions are not used as labels
         if Counter([round(ŷ_i, 4) for ŷ_i in ŷ]).most_common(1)[0][1] > len(ŷ)/10:
-            return y_current
+            return None
         ŷ =  np.array([ŷ_i if yinit_i else yinit_i for ŷ_i,yinit_i in zip(ŷ, y_init, strict = True)])
         return ŷ
     
@@ -131,10 +237,23 @@ class classifier():
         y_init = copy(y)
         
         self.args.logs.debug(f'Fitting started. There are {X.shape[0]} elements in the training dataset and {X_cut.shape[0]} elements in the FDR control set.')
-        #run the I-EM algorithm
+        #run the I-EM algorithm, each round is warm started from the last one
+        self.model = self._get_model()
         self._fit_one_step(X, y)
-        for _ in range(niter):
-            y = self._update_y(X, y_init, y)
+        for i in range(niter):
+            new_y = self._update_y(X, y_init)
+            if new_y is None:
+                #the labels are kept and the model is refit on them, this is not convergence
+                self.args.logs.warning(f'I-EM round {i + 1} gave degenerate predictions, the labels were not updated.')
+                self._fit_one_step(X, y)
+                continue
+            change = np.mean(np.abs(np.asarray(new_y, dtype = float) - np.asarray(y, dtype = float)))
+            self.history['label_change'].append(change)
+            self.args.logs.debug(f'I-EM round {i + 1} changed the labels by {change:.4g} on average.')
+            if change < self.tolerance:
+                self.args.logs.debug(f'I-EM has converged, the remaining {niter - i - 1} rounds are skipped.')
+                break
+            y = new_y
             self._fit_one_step(X, y)
         
         #do FDR control
@@ -6,15 +6,104 @@ Created on Mon Jul 22 11:34:30 2024
 @author: 4vt
 """
 
-from scipy.optimize import basinhopping
-from scipy.stats import betabinom, binom
+from functools import cache, lru_cache
+
+from scipy.optimize import basinhopping, minimize, OptimizeResult
+from scipy.special import gammaln, betaln, xlogy, xlog1py, digamma
 import numpy as np
 
 rng = np.random.default_rng(1)
 
+@cache
+def log_binom_coef(n):
+    #log(n choose k) for k in range(n), the support used by all label distributions
+    k = np.arange(n)
+    return k, gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+#the pmfs broadcast over parameter arrays, adding a trailing axis of length n
+def binom_pmf(n, p):
+    k, log_coef = log_binom_coef(n)
+    p = np.asarray(p)[..., np.newaxis]
+    return np.exp(log_coef + xlogy(k, p) + xlog1py(n - k, -p))
+
+def betabinom_pmf(n, a, b):
+    k, log_coef = log_binom_coef(n)
+    a = np.asarray(a)[..., np.newaxis]
+    b = np.asarray(b)[..., np.newaxis]
+    return np.exp(log_coef + betaln(k + a, n - k + b) - betaln(a, b))
+
+#derivatives of the pmfs with respect to each distribution parameter, same shapes as the pmfs
+def binom_pmf_grad(n, p):
+    k, log_coef = log_binom_coef(n)
+    p = np.asarray(p)[..., np.newaxis]
+    #k*p**(k-1)*(1-p)**(n-k) - (n-k)*p**k*(1-p)**(n-k-1), finite at p = 0 and p = 1
+    rising = k*np.exp(log_coef + xlogy(np.maximum(k - 1, 0), p) + xlog1py(n - k, -p))
+    falling = (n - k)*np.exp(log_coef + xlogy(k, p) + xlog1py(n - k - 1, -p))
+    return rising - falling
+
+def betabinom_pmf_grad(n, a, b):
+    pmf = betabinom_pmf(n, a, b)
+    k = np.arange(n)
+    a = np.asarray(a)[..., np.newaxis]
+    b = np.asarray(b)[..., np.newaxis]
+    common = digamma(a + b) - digamma(n + a + b)
+    da = pmf*(digamma(k + a) - digamma(a) + common)
+    db = pmf*(digamma(n - k + b) - digamma(b) + common)
+    return da, db
+
+@lru_cache(maxsize = 1024)
+def _background_matrix(n, npeaks, background):
+    #column j is the background packet shifted down by j peaks and truncated to npeaks
+    shift = np.arange(npeaks)[:, np.newaxis] - np.arange(n)[np.newaxis, :]
+    valid = np.logical_and(shift >= 0, shift < len(background))
+    return np.where(valid, np.asarray(background)[np.clip(shift, 0, len(background) - 1)], 0.0)
+
+def background_matrix(peptide):
+    """
+    The Toeplitz matrix T for which T @ label equals the convolution of a label distribution 
+    with the peptide background packet reshaped to peptide.npeaks.
+    """
+    return _background_matrix(peptide.formula[peptide.label_elm], peptide.npeaks, tuple(peptide.background))
+
+def winsorized_loss(exp, obs, weights = None):
+    """
+    The loss of DataGeneratingProcess.loss for many parameter sets and peptides at once.
+    exp is (peptides x parameter sets x peaks), obs and weights are (peptides x PSMs x peaks) 
+    with NaN for missing or padded values. Returns a (peptides x parameter sets) array.
+    """
+    resids = np.abs(exp[:, :, np.newaxis, :] - obs[:, np.newaxis, :, :])
+    resids = resids.reshape(resids.shape[0], resids.shape[1], -1)
+    #linearly interpolated 90th percentile of the non-NaN residuals, NaNs sort to the end
+    ordered = np.sort(resids, axis = -1)
+    count = np.sum(np.logical_not(np.isnan(ordered)), axis = -1, keepdims = True)
+    h = np.maximum(count - 1, 0)*0.9
+    lo = np.floor(h).astype(int)
+    hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+    v_lo = np.take_along_axis(ordered, lo, axis = -1)
+    v_hi = np.take_along_axis(ordered, hi, axis = -1)
+    q9 = v_lo + (h - lo)*(v_hi - v_lo)
+    resids = np.where(resids >= q9, q9, resids)
+    if weights is None:
+        return np.nansum(resids, axis = -1)
+    weights = weights.reshape(weights.shape[0], 1, -1)
+    return np.nansum(resids*weights, axis = -1)/np.nansum(weights, axis = -1)
+
 class results():
+    #scalar fields reported for every fit and their types, optimizer fields are missing for some fitting paths
+    report_fields = {'fit':float,
+                     'mean_label_probability':float,
+                     'variance':float,
+                     'fun':float,
+                     'nfev':int,
+                     'nit':int,
+                     'njev':int,
+                     'status':int,
+                     'minimization_failures':int,
+                     'success':bool}
+    
     def __init__(self, dgp, peptide, minimizer_results):
-        self.__dict__.update({k:v for k,v in minimizer_results.__dict__.items() if not k.startswith('__')})
+        #OptimizeResult keeps its fields as dictionary items rather than attributes
+        self.__dict__.update({k:v for k,v in minimizer_results.items() if k in self.report_fields})
         self.params = minimizer_results.x
         self.fit = minimizer_results.fun
         self.dgp_name = dgp.name
@@ -25,66 +114,239 @@ class DataGeneratingProcess():
     def __init__(self, args):
         self.name = NotImplemented
         self.bounds = NotImplemented
+        self.quiescent_mix = False
+        #the name of a simpler model whose fit can seed this one
+        self.nested = None
         self.weights = 1
+        self.patience = args.fit_patience if args.fit_patience > 0 else None
+        self.reweight_tolerance = args.reweight_tolerance
     
-    def expected(self, peptide, params):
+    def label_dist(self, n, params):
         raise NotImplementedError()
     
+    def _expected(self, n, background, unenriched, params):
+        #params is (..., parameter sets x parameters), background is (..., npeaks x n), unenriched is (..., npeaks)
+        exp = self.label_dist(n, params) @ np.swapaxes(background, -1, -2)
+        if self.quiescent_mix:
+            #the first parameter is the fraction of the population that is growing
+            frac = params[..., :1]
+            exp = (unenriched[..., np.newaxis, :]*(1-frac)) + (exp*frac)
+        exp = exp/np.nansum(exp, axis = -1, keepdims = True)
+        return exp
+    
+    def expected(self, peptide, params):
+        params = np.asarray(params, dtype = float)[np.newaxis, :]
+        return self._expected(peptide.formula[peptide.label_elm], 
+                              background_matrix(peptide), 
+                              peptide.unenriched, 
+                              params)[0]
+    
     def loss(self, params, peptide):
         exp = self.expected(peptide, params)
         #absolute error
         resids = np.abs(exp[np.newaxis, :] - peptide.obs)
         #winsorize at the 90th percentile
-        q9 = np.nanquantile(resids, 0.9)
-        resids[resids >= q9] = q9
+        observed = resids[np.logical_not(np.isnan(resids))]
+        if not observed.size:
+            #parameters without any comparable residuals are not a good fit
+            return np.nan
+        q9 = np.quantile(observed, 0.9)
+        resids = np.where(resids >= q9, q9, resids)
         return np.nansum(resids*self.weights)/np.nansum(self.weights)
     
+    def label_dist_grad(self, n, params):
+        #derivative of label_dist with respect to each parameter (parameters x n)
+        raise NotImplementedError()
+    
+    def expected_grad(self, peptide, params):
+        """
+        The expected distribution and its derivative with respect to each parameter (parameters x peaks).
+        """
+        params = np.asarray(params, dtype = float)
+        T = background_matrix(peptide)
+        n = peptide.formula[peptide.label_elm]
+        exp = self.label_dist(n, params) @ T.T
+        dexp = self.label_dist_grad(n, params) @ T.T
+        if self.quiescent_mix:
+            frac = params[0]
+            dexp = dexp*frac
+            dexp[0] = exp - peptide.unenriched
+            exp = (peptide.unenriched*(1-frac)) + (exp*frac)
+        total = np.nansum(exp)
+        exp = exp/total
+        dexp = (dexp - exp*np.nansum(dexp, axis = -1, keepdims = True))/total
+        return exp, dexp
+    
+    def loss_and_grad(self, params, peptide):
+        """
+        The loss and its gradient, for use with jac = True in scipy.optimize.minimize.
+        The 90th percentile used for winsorizing is differentiated through the residuals it interpolates.
+        """
+        exp, dexp = self.expected_grad(peptide, params)
+        diff = exp[np.newaxis, :] - peptide.obs
+        resids = np.abs(diff)
+        dresids = np.sign(diff)[np.newaxis, :, :]*dexp[:, np.newaxis, :]
+        observed = np.logical_not(np.isnan(resids))
+        if not np.any(observed):
+            return np.nan, np.full(len(params), np.nan)
+        q9 = np.quantile(resids[observed], 0.9)
+        #locate the two residuals np.quantile interpolates between
+        order = np.argsort(resids[observed], kind = 'stable')
+        h = (order.size - 1)*0.9
+        lo = int(np.floor(h))
+        hi = min(lo + 1, order.size - 1)
+        dq9 = (1 - (h - lo))*dresids[:, observed][:, order[lo]] + (h - lo)*dresids[:, observed][:, order[hi]]
+        clipped = resids >= q9
+        resids = np.where(clipped, q9, resids)
+        dresids = np.where(clipped[np.newaxis, :, :], dq9[:, np.newaxis, np.newaxis], dresids)
+        total = np.nansum(self.weights)
+        fun = np.nansum(resids*self.weights)/total
+        grad = np.nansum(dresids*self.weights, axis = (1, 2))/total
+        return fun, grad
+    
     def get_x0(self, peptide):
         raise NotImplementedError()
     
     def extra_data(self, peptide, result):
         return {}
     
-    def fit(self, peptide):
+    def seed(self, params):
+        #starting parameters equivalent to the fitted parameters of the nested model
+        raise NotImplementedError()
+    
+    def fit(self, peptide, nested_fit = None):
         x_0 = self.get_x0(peptide)
         args = {'args':(peptide,), 
                 # 'method':'SLSQP',#'Powell', 
-                'bounds':self.bounds}
+                'bounds':self.bounds,
+                'jac':True}
         self.weights = 1
-        result = basinhopping(self.loss, 
+        if nested_fit is not None:
+            seed = self.seed(nested_fit.params)
+            if self.loss(seed, peptide) < self.loss(x_0, peptide):
+                x_0 = seed
+        result = basinhopping(self.loss_and_grad, 
                               x_0,
                               T=2,
                               minimizer_kwargs = args,
-                              take_step = self.take_step)
+                              take_step = self.take_step,
+                              niter_success = self.patience)
         
         #re-run fitting starting from previous best model but down-weight large residuals        
         exp = self.expected(peptide, result.x)
         self.weights = 1 - np.abs(exp[np.newaxis, :] - peptide.obs)
-        result = basinhopping(self.loss, 
-                              result.x,
-                              T=2,
-                              minimizer_kwargs = args,
-                              take_step = self.take_step,
-                              niter = 50)
+        if np.nanmax(self.weights) - np.nanmin(self.weights) < self.reweight_tolerance:
+            #the weights barely change the objective so the first optimum stands, scored with the weights
+            result = OptimizeResult(x = result.x, fun = self.loss(result.x, peptide), success = True, 
+                                    message = 'reweighting skipped')
+        else:
+            result = basinhopping(self.loss_and_grad, 
+                                  result.x,
+                                  T=2,
+                                  minimizer_kwargs = args,
+                                  take_step = self.take_step,
+                                  niter = 50,
+                                  niter_success = self.patience)
+        return results(self, peptide, result)
+    
+    def _population_search(self, n, background, unenriched, obs, weights, starts, 
+                           population = 128, elite = 16, rounds = 40):
+        """
+        Vectorized cross-entropy search over a group of peptides that share n and npeaks.
+        Each peptide keeps a population of parameter sets that is resampled around its best members.
+        Returns the best parameters (peptides x parameters) and their losses.
+        """
+        span = self.take_step.xmax - self.take_step.xmin
+        n_peps = obs.shape[0]
+        if starts is None:
+            pop = rng.uniform(self.take_step.xmin, self.take_step.xmax, (n_peps, population, len(span)))
+            pop[:, 0, :] = self.get_x0(None)
+        else:
+            pop = starts[:, np.newaxis, :] + rng.normal(0, 0.1, (n_peps, population, len(span)))*span
+            pop[:, 0, :] = starts
+        pop = self.take_step.clip(pop)
+        best_x = pop[:, 0, :].copy()
+        best_fun = np.full(n_peps, np.inf)
+        for _ in range(rounds):
+            losses = winsorized_loss(self._expected(n, background, unenriched, pop), obs, weights)
+            losses[np.isnan(losses)] = np.inf
+            order = np.argsort(losses, axis = 1)
+            improved = losses[np.arange(n_peps), order[:, 0]] < best_fun
+            best_fun[improved] = losses[improved, order[improved, 0]]
+            best_x[improved] = pop[improved, order[improved, 0], :]
+            #sample around the elites with their full covariance so that correlated parameters can move along ridges
+            elites = np.take_along_axis(pop, order[:, :elite, np.newaxis], axis = 1)
+            mean = elites.mean(axis = 1, keepdims = True)
+            centered = elites - mean
+            cov = np.swapaxes(centered, 1, 2) @ centered/(elite - 1) + np.diag((1e-4*span)**2)
+            chol = np.linalg.cholesky(cov)
+            pop = self.take_step.clip(mean + rng.normal(size = pop.shape) @ np.swapaxes(chol, 1, 2))
+            pop[:, 0, :] = best_x
+        return best_x, best_fun
+    
+    def fit_batch(self, peptides, population = 128, max_elements = 2**22):
+        """
+        Fit many peptides with a vectorized population search followed by a local refinement of each peptide.
+        Peptides are grouped by their number of label atoms and peaks so that each group is evaluated as one array.
+        """
+        fits = [None]*len(peptides)
+        groups = {}
+        for i, peptide in enumerate(peptides):
+            groups.setdefault((peptide.formula[peptide.label_elm], peptide.npeaks), []).append(i)
+        for (n, npeaks), members in groups.items():
+            #split large groups to bound the size of the residual arrays
+            max_psms = max(peptides[i].obs.shape[0] for i in members)
+            chunk = max(1, int(max_elements//(population*max_psms*npeaks)))
+            for start in range(0, len(members), chunk):
+                idx = members[start:start + chunk]
+                background = np.array([background_matrix(peptides[i]) for i in idx])
+                unenriched = np.array([peptides[i].unenriched for i in idx])
+                obs = np.full((len(idx), max_psms, npeaks), np.nan)
+                for j, i in enumerate(idx):
+                    obs[j, :peptides[i].obs.shape[0], :] = peptides[i].obs
+                
+                x, _ = self._population_search(n, background, unenriched, obs, None, None, population = population)
+                #down-weight large residuals and search again around the previous best model
+                exp = self._expected(n, background, unenriched, x[:, np.newaxis, :])
+                weights = 1 - np.abs(exp - obs)
+                x, fun = self._population_search(n, background, unenriched, obs, weights, x, population = population, rounds = 20)
+                
+                for j, i in enumerate(idx):
+                    fits[i] = self._refine(peptides[i], x[j], fun[j], weights[j, :peptides[i].obs.shape[0], :])
+        return fits
+    
+    def _refine(self, peptide, x, fun, weights):
+        self.weights = weights
+        result = minimize(self.loss, x, args = (peptide,), bounds = self.bounds, method = 'Powell')
+        if not result.fun <= fun:
+            result = OptimizeResult(x = x, fun = fun, success = True, message = 'population search optimum')
         return results(self, peptide, result)
 
-class BBRandomDisplacementBounds(object):
-    """random displacement with bounds for betabinomial models"""
+class RandomDisplacementBounds(object):
+    """random displacement within bounds"""
     def __init__(self, bounds, stepsize=0.5):
         self.xmin = np.array([b[0] for b in bounds])
         self.xmax = np.array([b[1] for b in bounds])
         self.stepsize = stepsize
+    
+    def clip(self, x):
+        """move parameters, or an array of parameter sets along the last axis, inside the bounds"""
+        return np.clip(x, self.xmin, self.xmax)
 
     def __call__(self, x):
         """take a random step but ensure the new position is within the bounds"""
-        xnew = np.clip(x + rng.uniform(-self.stepsize, 
-                                       self.stepsize, 
-                                       np.shape(x)),
-                       self.xmin,
-                       self.xmax)
+        xnew = self.clip(x + rng.uniform(-self.stepsize, 
+                                         self.stepsize, 
+                                         np.shape(x)))
+        return xnew
+
+class BBRandomDisplacementBounds(RandomDisplacementBounds):
+    """random displacement with bounds for betabinomial models"""
+    def clip(self, x):
+        xnew = np.clip(x, self.xmin, self.xmax)
         #this boundry limits the mean enrichment to >= 0.05
         #the a parameter must be second to last and the b parameter must be last
-        xnew[-2] = np.clip(xnew[-2], xnew[-1]/19, self.xmax[-2])
+        xnew[..., -2] = np.clip(xnew[..., -2], xnew[..., -1]/19, self.xmax[-2])
         return xnew
 
 class BetabinomQuiescentMix(DataGeneratingProcess):
@@ -94,6 +356,8 @@ class BetabinomQuiescentMix(DataGeneratingProcess):
         self.bounds = [(0.05,1),
                        (1,100),
                        (1,100)]
+        self.quiescent_mix = True
+        self.nested = 'Betabinom'
         self.take_step = BBRandomDisplacementBounds(self.bounds)
     
     def extra_data(self, peptide, result):
@@ -105,16 +369,15 @@ class BetabinomQuiescentMix(DataGeneratingProcess):
     def get_x0(self, peptide):
         return [0.5,4,3]
     
-    def expected(self, peptide, params):
-        label = betabinom.pmf(k = range(peptide.formula[peptide.label_elm]),
-                              n = peptide.formula[peptide.label_elm],
-                              a = params[1],
-                              b = params[2])
-        exp = np.convolve(label, peptide.background)
-        exp = peptide.reshape(exp)
-        exp = (peptide.unenriched*(1-params[0])) + (exp*params[0])
-        exp = exp/np.nansum(exp)
-        return exp
+    def seed(self, params):
+        #a fully growing population is the betabinomial model
+        return np.array([1, *params])
+    
+    def label_dist(self, n, params):
+        return betabinom_pmf(n, params[..., 1], params[..., 2])
+    
+    def label_dist_grad(self, n, params):
+        return np.stack([np.zeros(n), *betabinom_pmf_grad(n, params[1], params[2])])
 
 class Betabinom(DataGeneratingProcess):
     def __init__(self, args):
@@ -133,31 +396,14 @@ class Betabinom(DataGeneratingProcess):
     def get_x0(self, peptide):
         return [4,3]
 
-    def expected(self, peptide, params):
-        label = betabinom.pmf(k = range(peptide.formula[peptide.label_elm]),
-                              n = peptide.formula[peptide.label_elm],
-                              a = params[0],
-                              b = params[1])
-        exp = np.convolve(label, peptide.background)
-        exp = peptide.reshape(exp)
-        exp = exp/np.nansum(exp)
-        return exp
-
-class BinomRandomDisplacementBounds(object):
-    """random displacement with bounds for betabinomial models"""
-    def __init__(self, bounds, stepsize=0.5):
-        self.xmin = np.array([b[0] for b in bounds])
-        self.xmax = np.array([b[1] for b in bounds])
-        self.stepsize = stepsize
+    def label_dist(self, n, params):
+        return betabinom_pmf(n, params[..., 0], params[..., 1])
+    
+    def label_dist_grad(self, n, params):
+        return np.stack(betabinom_pmf_grad(n, params[0], params[1]))
 
-    def __call__(self, x):
-        """take a random step but ensure the new position is within the bounds"""
-        xnew = np.clip(x + rng.uniform(-self.stepsize, 
-                                       self.stepsize, 
-                                       np.shape(x)),
-                       self.xmin,
-                       self.xmax)
-        return xnew
+class BinomRandomDisplacementBounds(RandomDisplacementBounds):
+    """random displacement with bounds for binomial models"""
 
 class BinomQuiescentMix(DataGeneratingProcess):
     def __init__(self, args):
@@ -165,6 +411,8 @@ class BinomQuiescentMix(DataGeneratingProcess):
         self.name = 'BinomQuiescentMix'
         self.bounds = [(0.05,1),
                        (0.1,1)]
+        self.quiescent_mix = True
+        self.nested = 'Binom'
         self.take_step = BinomRandomDisplacementBounds(self.bounds)
     
     def extra_data(self, peptide, result):
@@ -176,15 +424,15 @@ class BinomQuiescentMix(DataGeneratingProcess):
     def get_x0(self, peptide):
         return [0.5,0.5]
     
-    def expected(self, peptide, params):
-        label = binom.pmf(k = range(peptide.formula[peptide.label_elm]),
-                          n = peptide.formula[peptide.label_elm],
-                          p = params[1])
-        exp = np.convolve(label, peptide.background)
-        exp = peptide.reshape(exp)
-        exp = (peptide.unenriched*(1-params[0])) + (exp*params[0])
-        exp = exp/np.nansum(exp)
-        return exp
+    def seed(self, params):
+        #a fully growing population is the binomial model, p is kept inside this model's bounds
+        return np.array([1, max(params[0], 0.1)])
+    
+    def label_dist(self, n, params):
+        return binom_pmf(n, params[..., 1])
+    
+    def label_dist_grad(self, n, params):
+        return np.stack([np.zeros(n), binom_pmf_grad(n, params[1])])
 
 class Binom(DataGeneratingProcess):
     def __init__(self, args):
@@ -194,7 +442,7 @@ class Binom(DataGeneratingProcess):
         self.take_step = BinomRandomDisplacementBounds(self.bounds)
 
     def extra_data(self, peptide, result):
-        p = result.x
+        p, = result.x
         n = peptide.formula[peptide.label_elm]
         variance = p*(1-p)
         return {'mean_label_probability':p, 'variance':variance}
@@ -202,11 +450,8 @@ class Binom(DataGeneratingProcess):
     def get_x0(self, peptide):
         return [0.5]
     
-    def expected(self, peptide, params):
-        label = binom.pmf(k = range(peptide.formula[peptide.label_elm]),
-                          n = peptide.formula[peptide.label_elm],
-                          p = params[0])
-        exp = np.convolve(label, peptide.background)
-        exp = peptide.reshape(exp)
-        exp = exp/np.nansum(exp)
-        return exp
\ No newline at end of file
+    def label_dist(self, n, params):
+        return binom_pmf(n, params[..., 0])
+    
+    def label_dist_grad(self, n, params):
+        return binom_pmf_grad(n, params[0])[np.newaxis, :]
@@ -11,10 +11,12 @@ from copy import copy
 import re
 import os
 from collections import defaultdict
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+import pickle
 
 import numpy as np
 from brainpy import isotopic_variants
-from sortedcontainers import SortedList
 
 
 Δm = {'H[2]':1.0062767458900002,
@@ -42,10 +44,173 @@ def base_name(filename):
 def isotope_packet(formula, charge):
     return np.array([p.intensity for p in isotopic_variants(formula, npeaks = 6, charge = charge)])
 
+def match_peaks(scans, targets, ppm = 10):
+    """
+    Find the closest peak within a ppm window of each target m/z in every scan.
+    Returns (intensity, error) matrices of shape (len(scans), len(targets)) where
+    error is target - observed m/z and unmatched targets are NaN.
+    """
+    targets = np.asarray(targets, dtype = float)
+    intensity = np.full((len(scans), len(targets)), np.nan)
+    error = np.full((len(scans), len(targets)), np.nan)
+    for row, scan in enumerate(scans):
+        mz = np.asarray(scan.mz, dtype = float)
+        i = np.asarray(scan.i, dtype = float)
+        if len(mz) == 0:
+            continue
+        #peaks are ordered by (m/z, intensity) so ties resolve the same way as a sorted peak list
+        if np.any(mz[1:] < mz[:-1]):
+            order = np.lexsort((i, mz))
+            mz = mz[order]
+            i = i[order]
+        #compare the nearest peak on either side of each target, preferring the lower one on ties
+        upper = np.searchsorted(mz, targets, side = 'left')
+        lower = np.maximum(upper, 1) - 1
+        upper = np.minimum(np.maximum(upper, 1), len(mz) - 1)
+        use_upper = np.abs(mz[upper] - targets) < np.abs(mz[lower] - targets)
+        idx = np.where(use_upper, upper, lower)
+        matched = np.abs(mz[idx] - targets) < (ppm/1e6)*targets
+        intensity[row, matched] = i[idx[matched]]
+        error[row, matched] = targets[matched] - mz[idx[matched]]
+    return intensity, error
+
 class Scan:
-    def __init__(self, scan):
-        self.scan = int(re.search(r'scan=(\d+)', scan.getNativeID()).group(1))
-        self.mz, self.i = scan.get_peaks()
+    def __init__(self, scan, mz, i):
+        self.scan = scan
+        self.mz = mz
+        self.i = i
+
+class ScanStore:
+    """
+    The MS1 peaks of one mzML file packed into contiguous arrays. The peaks of the k-th
+    scan are mz[offsets[k]:offsets[k+1]] and scans holds the sorted scan numbers.
+    The arrays can be moved into shared memory so that worker processes attach without copying.
+    """
+    def __init__(self, scans, offsets, mz, i, shm = None):
+        self.scans = scans
+        self.offsets = offsets
+        self.mz = mz
+        self.i = i
+        self.shm = shm
+    
+    @classmethod
+    def from_scans(cls, scans):
+        scans = sorted(scans, key = lambda s: s.scan)
+        lengths = [len(s.mz) for s in scans]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype = np.int64)))
+        mz = np.concatenate([np.asarray(s.mz, dtype = np.float64) for s in scans] + [np.zeros(0)])
+        i = np.concatenate([np.asarray(s.i, dtype = np.float32) for s in scans] + [np.zeros(0, dtype = np.float32)])
+        return cls(np.array([s.scan for s in scans], dtype = np.int64), offsets, mz, i)
+    
+    @staticmethod
+    def _layout(n_scans, n_peaks):
+        return [('scans', np.int64, n_scans),
+                ('offsets', np.int64, n_scans + 1),
+                ('mz', np.float64, n_peaks),
+                ('i', np.float32, n_peaks)]
+    
+    @classmethod
+    def _from_buffer(cls, shm, n_scans, n_peaks):
+        arrays = {}
+        offset = 0
+        for name, dtype, size in cls._layout(n_scans, n_peaks):
+            arrays[name] = np.ndarray((size,), dtype = dtype, buffer = shm.buf, offset = offset)
+            offset += arrays[name].nbytes
+        return cls(shm = shm, **arrays)
+    
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.scans, self.offsets, self.mz, self.i))
+    
+    @property
+    def handle(self):
+        return (self.shm.name, len(self.scans), len(self.mz))
+    
+    def share(self):
+        shm = shared_memory.SharedMemory(create = True, size = max(self.nbytes, 1))
+        shared = ScanStore._from_buffer(shm, len(self.scans), len(self.mz))
+        for name in ('scans', 'offsets', 'mz', 'i'):
+            getattr(shared, name)[:] = getattr(self, name)
+        return shared
+    
+    @classmethod
+    def attach(cls, handle):
+        name, n_scans, n_peaks = handle
+        return cls._from_buffer(shared_memory.SharedMemory(name = name), n_scans, n_peaks)
+    
+    def close(self):
+        #the array views must be released before the shared memory can be closed
+        self.scans = self.offsets = self.mz = self.i = None
+        if self.shm is not None:
+            self.shm.close()
+    
+    def unlink(self):
+        self.shm.unlink()
+    
+    def __len__(self):
+        return len(self.scans)
+    
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return Scan(int(self.scans[idx]), self.mz[start:end], self.i[start:end])
+    
+    def select(self, positions):
+        positions = np.asarray(positions, dtype = np.int64)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype = np.int64)))
+        peaks = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return ScanStore(self.scans[positions], offsets, self.mz[peaks], self.i[peaks])
+    
+    def neighbourhood(self, scan, width = 3):
+        idx = int(np.searchsorted(self.scans, scan, side = 'left'))
+        return [self[k] for k in range(max(0, idx - width), min(len(self), idx + width + 1))]
+
+def clean_seq(seq):
+    #The regex excludes non bracket characters at the beginning or end of the string that are demarcated from 
+    #the middle with a period, e.g. T.ES.T -> ES, this allows it to work with Proteome discoverer annotated sequences.
+    #The capturing group in the middle grabs a sequence of residues. These residues start with a character that is
+    #neither whitespace nor an open bracket and are optionally followed by an arbitrary number of characters contained
+    #by brackets, the only constraint on these characters is that they do not contain a close bracket.
+    seq = re.search(r'\A(?:[^\.\[]+\.)?((?:[^\[\s\.](?:\[[^\]]+\])?)+)(?:\.[^\.\]]+)?\Z',seq).group(1)
+    return seq
+
+def label_element(label):
+    return re.search(r'[A-Z][a-z]?', label).group()
+
+def calc_formula(sequence, aa_formulae):
+    formula = defaultdict(lambda: 0)
+    residues = re.findall(r'[^\[](?:\[[^\]]+\])?', sequence)
+    for aa in residues:
+        for k,v in aa_formulae[aa].items():
+            formula[k] += v
+    formula['H'] += 2
+    formula['O'] += 1
+    formula = hashabledict(formula)
+    return formula
+
+def calc_mz(formula, charge, label):
+    label_elm = label_element(label)
+    mz_0 = isotopic_variants(formula, npeaks=1, charge = charge)[0].mz
+    init_mz = [p.mz for p in isotopic_variants(formula, npeaks=6, charge = charge)]
+    mz = mz_0 + ((np.asarray(range(len(init_mz), formula[label_elm] + 1))*Δm[label])/charge)
+    comp = copy(formula)
+    comp[label] = comp.pop(label_elm)
+    terminal_mz = [p.mz for p in isotopic_variants(comp, npeaks = 30, charge = charge)][1:]
+    mz = np.concatenate((init_mz, mz, terminal_mz), axis = None)
+    return mz
+
+def calc_theory(sequence, charge, label, aa_formulae):
+    """
+    The theoretical quantities shared by every PSM of a (sequence, charge, label):
+    the formula, the m/z ladder, and the background and unenriched isotope packets.
+    """
+    formula = calc_formula(sequence, aa_formulae)
+    mz = calc_mz(formula, charge, label)
+    background = isotope_packet(formula.omit(label_element(label)), charge)
+    unenriched = isotope_packet(formula, charge)
+    unenriched = np.concatenate((unenriched, np.zeros(len(mz)-len(unenriched))))
+    return formula, mz, background, unenriched
 
 class psm:
     def __init__(self,
@@ -58,7 +223,8 @@ class psm:
                  design_metadata,
                  label,
                  is_labeled,
-                 args):
+                 args,
+                 theory = None):
         
         self.raw_sequence = raw_sequence
         self.file = file
@@ -68,76 +234,25 @@ class psm:
         self.psm_metadata = psm_metadata
         self.design_metadata = design_metadata
         self.label = label
-        self.label_elm = re.search(r'[A-Z][a-z]?', label).group()
+        self.label_elm = label_element(label)
         self.is_labeled = is_labeled
-        self.aa_formulae = args.aa_formulae
         
-        self.sequence = self.clean_seq(self.raw_sequence)
+        self.sequence = clean_seq(self.raw_sequence)
         self.base_name = base_name(self.file)
 
-        self.formula = self.calc_formula()
-        self.mz = self.calc_mz()
-        subformula = self.formula.omit(self.label_elm)
-        self.background = isotope_packet(subformula, self.charge)
-        unenriched = isotope_packet(self.formula, self.charge)
-        self.unenriched = np.concatenate((unenriched, np.zeros(len(self.mz)-len(unenriched))))
+        #theoretical values are usually computed once per peptide ion and shared between PSMs
+        if theory is None:
+            theory = calc_theory(self.sequence, self.charge, self.label, args.aa_formulae)
+        self.formula, self.mz, self.background, self.unenriched = theory
         return
     
     def __repr__(self):
         return repr(self.__dict__)
     
-    def clean_seq(self, seq):
-        #The regex excludes non bracket characters at the beginning or end of the string that are demarcated from 
-        #the middle with a period, e.g. T.ES.T -> ES, this allows it to work with Proteome discoverer annotated sequences.
-        #The capturing group in the middle grabs a sequence of residues. These residues start with a character that is
-        #neither whitespace nor an open bracket and are optionally followed by an arbitrary number of characters contained
-        #by brackets, the only constraint on these characters is that they do not contain a close bracket.
-        seq = re.search(r'\A(?:[^\.\[]+\.)?((?:[^\[\s\.](?:\[[^\]]+\])?)+)(?:\.[^\.\]]+)?\Z',seq).group(1)
-        return seq
-    
-    def calc_mz(self):
-        mz_0 = isotopic_variants(self.formula, npeaks=1, charge = self.charge)[0].mz
-        init_mz = [p.mz for p in isotopic_variants(self.formula, npeaks=6, charge = self.charge)]
-        mz = mz_0 + ((np.asarray(range(len(init_mz), self.formula[self.label_elm] + 1))*Δm[self.label])/self.charge)
-        comp = copy(self.formula)
-        comp[self.label] = comp.pop(self.label_elm)
-        terminal_mz = [p.mz for p in isotopic_variants(comp, npeaks = 30, charge = self.charge)][1:]
-        mz = np.concatenate((init_mz, mz, terminal_mz), axis = None)
-        return mz
-
-    def calc_formula(self):
-        formula = defaultdict(lambda: 0)
-        residues = re.findall(r'[^\[](?:\[[^\]]+\])?', self.sequence)
-        for aa in residues:
-            for k,v in self.aa_formulae[aa].items():
-                formula[k] += v
-        formula['H'] += 2
-        formula['O'] += 1
-        formula = hashabledict(formula)
-        return formula
-    
-    def mymin(self, peaks, mz):
-        idx = max(1,peaks.bisect_left((mz,)))
-        query = min(peaks[idx-1:idx+1], 
-                    key = lambda x: abs(x[0] - mz), 
-                    default = (np.nan,))
-        if abs(query[0] - mz)  < (10/1e6)*mz:
-            return query
-        else:
-            return (np.nan, np.nan)
-    
     def parse_scans(self, scans):
-        all_peaks = []
-        all_errs = []
-        for scan in scans:
-            peak_list = SortedList(zip(scan.mz, scan.i, strict = True))
-            peaks = [self.mymin(peak_list, mz) for mz in self.mz]
-            mz_errs = np.asarray([mz - p[0] for p,mz in zip(peaks,self.mz, strict = True)])
-            all_errs.append(mz_errs)
-            peaks = np.asarray([p[1] for p in peaks])
-            all_peaks.append(peaks)
-        self.intensity = np.nanmean(all_peaks, axis = 0).tolist()
-        self.mz_err = np.nanmean(all_errs, axis = 0).tolist()
+        all_peaks, all_errs = match_peaks(scans, self.mz)
+        self.intensity = np.nanmean(all_peaks, axis = 0)
+        self.mz_err = np.nanmean(all_errs, axis = 0)
     
     def is_useable(self):
         finite = np.isfinite(self.intensity)
@@ -152,6 +267,147 @@ class psm:
                     return True
         return False
 
+class PSMTable:
+    """
+    Columnar storage for many PSMs, used to save and load step 1 checkpoints. The pipeline 
+    stages themselves still work on lists of psm objects. Scalar fields are stored as arrays, 
+    theoretical packets and design metadata once per unique peptide ion and file, and the per-PSM 
+    intensity and m/z error arrays are concatenated into flat buffers where PSM k spans 
+    offsets[k]:offsets[k+1]. Indexing the table returns a psm object whose arrays are views into the table.
+    """
+    columns = {'raw_sequence':object,
+               'file':object,
+               'scan':np.int64,
+               'charge':np.int64,
+               'proteins':object,
+               'label':object,
+               'is_labeled':bool,
+               'sequence':object}
+    
+    def __init__(self, data, psm_metadata, designs, design_idx, theories, theory_idx, 
+                 intensity = None, mz_err = None, offsets = None):
+        self.data = data
+        self.psm_metadata = psm_metadata
+        self.designs = designs
+        self.design_idx = design_idx
+        self.theories = theories
+        self.theory_idx = theory_idx
+        self.intensity = intensity
+        self.mz_err = mz_err
+        self.offsets = offsets
+    
+    @classmethod
+    def from_psms(cls, psms):
+        data = {c:np.array([getattr(p, c) for p in psms], dtype = t) for c,t in cls.columns.items()}
+        psm_metadata = np.empty(len(psms), dtype = object)
+        psm_metadata[:] = [p.psm_metadata for p in psms]
+        
+        #design metadata is stored once per file and theoretical packets once per peptide ion
+        design_keys = {}
+        design_idx = np.array([design_keys.setdefault(p.base_name, len(design_keys)) for p in psms], dtype = np.int64)
+        designs = [None]*len(design_keys)
+        theory_keys = {}
+        theory_idx = np.array([theory_keys.setdefault((p.sequence, p.charge, p.label), len(theory_keys)) for p in psms], dtype = np.int64)
+        theories = [None]*len(theory_keys)
+        for p, d, t in zip(psms, design_idx, theory_idx, strict = True):
+            designs[d] = p.design_metadata
+            theories[t] = (p.formula, p.mz, p.background, p.unenriched)
+        
+        if psms and all(hasattr(p, 'intensity') for p in psms):
+            lengths = [len(p.intensity) for p in psms]
+            offsets = np.concatenate(([0], np.cumsum(lengths, dtype = np.int64)))
+            intensity = np.concatenate([np.asarray(p.intensity, dtype = float) for p in psms])
+            mz_err = np.concatenate([np.asarray(p.mz_err, dtype = float) for p in psms])
+        else:
+            offsets = intensity = mz_err = None
+        return cls(data, psm_metadata, designs, design_idx, theories, theory_idx, intensity, mz_err, offsets)
+    
+    def __len__(self):
+        return len(self.theory_idx)
+    
+    def __getitem__(self, idx):
+        view = psm.__new__(psm)
+        view.raw_sequence = self.data['raw_sequence'][idx]
+        view.file = self.data['file'][idx]
+        view.scan = int(self.data['scan'][idx])
+        view.charge = int(self.data['charge'][idx])
+        view.proteins = self.data['proteins'][idx]
+        view.psm_metadata = self.psm_metadata[idx]
+        view.design_metadata = self.designs[self.design_idx[idx]]
+        view.label = self.data['label'][idx]
+        view.label_elm = label_element(view.label)
+        view.is_labeled = bool(self.data['is_labeled'][idx])
+        view.sequence = self.data['sequence'][idx]
+        view.base_name = base_name(view.file)
+        view.formula, view.mz, view.background, view.unenriched = self.theories[self.theory_idx[idx]]
+        if self.offsets is not None:
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            view.intensity = self.intensity[start:end]
+            view.mz_err = self.mz_err[start:end]
+        return view
+    
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+    
+    def to_psms(self):
+        return list(self)
+    
+    def save(self, directory):
+        """
+        Write the table to directory. Numeric columns and the intensity and m/z error buffers are 
+        written in parallel as .npy files that load() memory-maps, everything else goes in one small pickle.
+        """
+        os.makedirs(directory, exist_ok = True)
+        arrays = {c:self.data[c] for c,t in self.columns.items() if t is not object}
+        arrays.update({'design_idx':self.design_idx, 'theory_idx':self.theory_idx})
+        if self.offsets is not None:
+            arrays.update({'intensity':self.intensity, 'mz_err':self.mz_err, 'offsets':self.offsets})
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(lambda item: np.save(os.path.join(directory, f'{item[0]}.npy'), item[1]), arrays.items()))
+        metadata = {'data':{c:self.data[c] for c,t in self.columns.items() if t is object},
+                    'psm_metadata':self.psm_metadata,
+                    'designs':self.designs,
+                    'theories':self.theories}
+        with open(os.path.join(directory, 'metadata.pkl'), 'wb') as pkl:
+            pickle.dump(metadata, pkl, protocol = pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def load(cls, directory, mmap_mode = 'r'):
+        """Read a table written by save(), the numeric arrays are only read from disk when they are used."""
+        def array(name):
+            path = os.path.join(directory, f'{name}.npy')
+            return np.load(path, mmap_mode = mmap_mode) if os.path.exists(path) else None
+        with open(os.path.join(directory, 'metadata.pkl'), 'rb') as pkl:
+            metadata = pickle.load(pkl)
+        data = metadata['data']
+        data.update({c:array(c) for c,t in cls.columns.items() if t is not object})
+        return cls(data, 
+                   metadata['psm_metadata'], 
+                   metadata['designs'], 
+                   array('design_idx'), 
+                   metadata['theories'], 
+                   array('theory_idx'),
+                   array('intensity'),
+                   array('mz_err'),
+                   array('offsets'))
+
+class fit_data:
+    """
+    The parts of a peptide that model fitting reads. 
+    These are small and cheap to send to worker processes.
+    """
+    def __init__(self, peptide):
+        self.label_elm = peptide.label_elm
+        self.formula = {peptide.label_elm:peptide.formula[peptide.label_elm]}
+        self.background = peptide.background
+        self.npeaks = peptide.npeaks
+        self.unenriched = peptide.unenriched
+        self.obs = peptide.obs
+    
+    def cost(self):
+        #fit time grows with the size of the label distribution and the number of observations
+        return self.formula[self.label_elm]*self.obs.size
+
 class peptide:
     def __init__(self, psms):
         psm = psms[0]
@@ -167,7 +423,10 @@ class peptide:
         self.psm_metadata = [p.psm_metadata for p in psms]
         normed = [np.asarray(p.intensity)/np.nansum(p.intensity) for p in self.psms]
         self.npeaks = max([len(n) for n in normed])
-        self.obs = np.array([self.clean(np.concatenate((n, np.full(self.npeaks - len(n), np.nan)))) for n in normed])
+        obs = np.full((len(normed), self.npeaks), np.nan)
+        for row, n in zip(obs, normed):
+            row[:len(n)] = n
+        self.obs = self.clean(obs)
         self.unenriched = self.reshape(psm.unenriched)
         self.mz_err = np.array([self.reshape(p.mz_err) for p in self.psms])
         self.fit_results = []
@@ -177,33 +436,31 @@ class peptide:
         return repr(self.__dict__)
     
     def clean(self, vals):
+        """Filters the (PSMs x npeaks) matrix of normalized intensities one row per PSM."""
         vals = copy(vals)
-        #remove singletons
-        for i in range(1, len(vals)-1):
-            if np.sum(np.isnan(vals[i-1:i+2])) > 1:
-                vals[i] = np.nan
+        #remove singletons, a point is dropped if it and one neighbor or both neighbors are missing
+        nans = np.isnan(vals)
+        windows = nans[:, :-2].astype(int) + nans[:, 1:-1] + nans[:, 2:]
+        vals[:, 1:-1][windows > 1] = np.nan
         #remove points far from the trend
         nans = np.isnan(vals)
-        vals[nans] = np.zeros(len(vals))[nans]
-        evens = vals[np.array(range(len(vals)))%2 == 0]
-        odds = vals[np.array(range(len(vals)))%2 == 1]
-        odd_interp = np.interp(range(1,len(vals), 2), range(0,len(vals), 2), evens)
-        even_interp = np.interp(range(0,len(vals), 2), range(1,len(vals), 2), odds)
-        if len(odd_interp) != len(even_interp):
-            resize = True
-            odd_interp = np.concatenate((odd_interp,[np.nan]))
-        else:
-            resize = False
-        interp = [v for pair in zip(even_interp, odd_interp, strict = True) for v in pair]
-        if resize:
-            interp = interp[:-1]
+        vals[nans] = 0
+        #each point is compared to the linear interpolation of the points of the other parity
+        evens = vals[:, 0::2]
+        odds = vals[:, 1::2]
+        interp = np.empty(vals.shape)
+        interp[:, 1::2][:, :evens.shape[1] - 1] = evens[:, :-1] + (evens[:, 1:] - evens[:, :-1])/2
+        interp[:, 1::2][:, evens.shape[1] - 1:] = evens[:, -1:]
+        interp[:, 0] = odds[:, 0]
+        interp[:, 2::2][:, :odds.shape[1] - 1] = odds[:, :-1] + (odds[:, 1:] - odds[:, :-1])/2
+        interp[:, 2::2][:, odds.shape[1] - 1:] = odds[:, -1:]
         Δinterp = vals - interp
-        Δinterp[nans] = np.full(len(vals), np.nan)[nans]
+        Δinterp[nans] = np.nan
         cutoff = 0.05
         badpts = Δinterp > cutoff
-        badpts[0] = False
-        vals[badpts] = np.full(len(vals),np.nan)[badpts]
-        vals = vals/np.nansum(vals)
+        badpts[:, 0] = False
+        vals[badpts] = np.nan
+        vals = vals/np.nansum(vals, axis = 1)[:, np.newaxis]
         return vals
     
     def reshape(self, arr):
@@ -214,7 +471,7 @@ class peptide:
         else:
             return arr
     
-    def report(self):
+    def report(self, metadata_columns):
         def good_elm(elm):
             return type(elm) == 'str' or not hasattr(elm, '__iter__')
         
@@ -224,13 +481,15 @@ class peptide:
         fields.update({k:v for k,v in self.__dict__.items() if good_elm(v)})
         fields.update(self.design_metadata)
         fields['PSM_count'] = len(self.psm_metadata)
-        psm_metadata_cols = set(k for m in self.psm_metadata for k in m.keys())
-        for metadata_col in psm_metadata_cols:
-            vals = [m[metadata_col] for m in self.psm_metadata]
-            if np.all(np.isreal(vals)):
-                fields[f'PSMs_mean_{metadata_col}'] = np.mean(vals)
+        #metadata_columns decides whether each key is averaged or listed
+        for key, column in metadata_columns.items():
+            vals = [m[key] for m in self.psm_metadata if key in m]
+            if not vals:
+                continue
+            if column.startswith('PSMs_mean_'):
+                fields[column] = np.mean(vals)
             else:
-                fields[f'PSMs_unique_{metadata_col}'] = ';'.join([str(v) for v in set(vals)])
+                fields[column] = ';'.join([str(v) for v in set(vals)])
         fields['canonical_DGP'] = self.canonical_fit.dgp_name
         fields.update({f'canonical_{k}':v for k,v in self.canonical_fit.__dict__.items() if good_elm(v)})
         fields.update({f'canonical_param{i}':v for i,v in enumerate(self.canonical_fit.params)})
@@ -8,8 +8,12 @@ Created on Wed Jul 24 11:29:53 2024
 
 from multiprocessing import Pool, Manager
 import traceback
+import threading
+import queue
 
 from isopacketModeler.data_generating_processes import BetabinomQuiescentMix, Betabinom, BinomQuiescentMix, Binom
+from isopacketModeler.data_objects import fit_data
+from isopacketModeler.make_peptides import peptide_fingerprint
 
 data_generating_processes = {'BetabinomQuiescentMix':BetabinomQuiescentMix,
                              'Betabinom':Betabinom,
@@ -25,59 +29,233 @@ natP = {'H[2]':0.00015,
         'S[34]':0.0421,
         'S[36]':0.0002}
 
+def init_worker(shared_event, args):
+    #each worker builds its own controller once instead of receiving it with every task
+    global event, controller
+    event = shared_event
+    controller = peptide_fit_conroller(args)
+
+def fit_chunk(chunk):
+    if event.is_set():
+        return []
+    try:
+        return [(i, name, controller.models[name].fit(data, nested_fit)) for i, name, data, nested_fit in chunk]
+    except:
+        traceback.print_exc()
+        event.set()
+        return []
+
+def fit_batch(chunk):
+    if event.is_set():
+        return []
+    try:
+        return list(zip([i for i, _ in chunk], controller.fit_batch([data for _, data in chunk]), strict = True))
+    except:
+        traceback.print_exc()
+        event.set()
+        return []
+
 class peptide_fit_conroller():
     def __init__(self, args):
         self.args = args
         self.DGPs = [data_generating_processes[p](args) for p in args.data_generating_processes]
+        self.models = {DGP.name:DGP for DGP in self.DGPs}
         self.cores = args.cores
 
     def model_selection(self, peptide):
-            peptide.canonical_fit = min(peptide.fit_results, key = lambda x: x.fit)
+        #a seeded model can tie the simpler model nested in it, ties go to the simpler model
+        peptide.canonical_fit = min(peptide.fit_results, key = lambda x: (x.fit, self.depth(x.dgp_name)))
+    
+    def depth(self, name):
+        #the number of simpler models nested in this one
+        nested = self.models[name].nested
+        return 0 if nested not in self.models else 1 + self.depth(nested)
 
-    def fit_all_DGPs(self, i):
-        if event.is_set():
-            return
-        try:
-            results = []
-            for DGP in self.DGPs:
-                results.append(DGP.fit(all_peptides[i]))
-            return results
-        except:
-            traceback.print_exc()
-            event.set()
+    def roots(self):
+        #models that do not wait on the fit of a simpler model
+        return [DGP for DGP in self.DGPs if DGP.nested not in self.models]
+    
+    def dependents(self, name):
+        return [DGP for DGP in self.DGPs if DGP.nested == name]
+    
+    def good_enough(self, fits):
+        #a fit this far below max_peptide_err makes fitting the remaining models unnecessary
+        threshold = self.args.max_peptide_err*self.args.skip_models_below
+        return any(f.fit < threshold for f in fits.values())
+    
+    def ordered_results(self, fits):
+        return [fits[DGP.name] for DGP in self.DGPs if DGP.name in fits]
+    
+    def fit_batch(self, peptides):
+        fits = [DGP.fit_batch(peptides) for DGP in self.DGPs]
+        return [list(r) for r in zip(*fits, strict = True)]
+    
+    def batches(self, data, size = 64):
+        #peptides with the same number of label atoms and peaks are evaluated as one array
+        groups = {}
+        for i, d in data:
+            groups.setdefault((d.formula[d.label_elm], d.npeaks), []).append((i, d))
+        return [group[i:i+size] for group in groups.values() for i in range(0, len(group), size)]
+    
+    def cost(self, task):
+        i, name, data, nested_fit = task
+        return data.cost()*len(self.models[name].bounds)
+    
+    def chunks(self, tasks, target):
+        """
+        Split (peptide, model) tasks into chunks of about target estimated fitting cost, most expensive first.
+        Expensive tasks get a chunk of their own so that they start early and do not hold up the tail.
+        """
+        chunks = []
+        chunk = []
+        chunk_cost = 0
+        for task in sorted(tasks, key = self.cost, reverse = True):
+            chunk.append(task)
+            chunk_cost += self.cost(task)
+            if chunk_cost >= target:
+                chunks.append(chunk)
+                chunk = []
+                chunk_cost = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+    
+    def keep(self, peptide):
+        #remove poorly fitting peptides and peptides that look unenriched
+        return (peptide.canonical_fit.fit < self.args.max_peptide_err and 
+                peptide.canonical_fit.mean_label_probability > (natP[peptide.label] + 0.01))
     
     def prune_peptides(self, peptides):
-        #remove poorly fitting peptides
-        peptides = [p for p in peptides if p.canonical_fit.fit < self.args.max_peptide_err]
-        #remove peptides that look unenriched
-        peptides = [p for p in peptides if p.canonical_fit.mean_label_probability > (natP[p.label] + 0.01)]
-        return peptides
+        return [p for p in peptides if self.keep(p)]
 
-    def fit_peptides(self, peptides):
+    def pending(self, fits):
+        #models that still need fitting and whose seed, if they have one, is available
+        if self.good_enough(fits):
+            return []
+        return [DGP for DGP in self.DGPs if DGP.name not in fits and (DGP.nested not in self.models or DGP.nested in fits)]
+    
+    def schedule(self, p, batches, fit_store = None, on_complete = None, chunks_per_core = 4):
+        """
+        Fit every (peptide, model) pair as its own task, or groups of peptides with the batched backend.
+        batches yields lists of peptides. It is read in a separate thread so that fitting starts as soon as 
+        the first list arrives. Models seeded by a simpler model are submitted as soon as that fit arrives.
+        on_complete(peptide, fits) is called as soon as every model of a peptide has been fit.
+        Returns the peptides and their fits keyed by model name.
+        """
+        peptides, data, keys, fits = [], [], [], []
+        #the number of submitted tasks of each peptide that have not returned
+        outstanding = []
+        def complete(idx):
+            for i in idx:
+                if outstanding[i] == 0 and on_complete is not None:
+                    on_complete(peptides[i], fits[i])
+        events = queue.Queue()
+        def read():
+            try:
+                for batch in batches:
+                    events.put(('peptides', batch))
+                events.put(('read', None))
+            except Exception as e:
+                events.put(('error', e))
+        threading.Thread(target = read, daemon = True).start()
+        
+        def submit(worker, chunk, kind):
+            p.apply_async(worker, (chunk,),
+                          callback = lambda r: events.put((kind, r)),
+                          error_callback = lambda e: events.put(('error', e)))
+        
+        reading = True
+        in_flight = 0
+        target = 0
+        while reading or in_flight:
+            kind, payload = events.get()
+            tasks = []
+            if kind == 'error':
+                raise payload
+            elif kind == 'read':
+                reading = False
+            elif kind == 'peptides':
+                new = range(len(peptides), len(peptides) + len(payload))
+                peptides.extend(payload)
+                data.extend(fit_data(pep) for pep in payload)
+                keys.extend(peptide_fingerprint(pep) for pep in payload)
+                #fits finished by an earlier, interrupted, run are not repeated
+                fits.extend(fit_store.get(k) if fit_store is not None else {} for k in keys[len(fits):])
+                outstanding.extend(0 for _ in new)
+                resumed = sum(len(fits[i]) for i in new)
+                if resumed:
+                    self.args.logs.info(f'{resumed} model fits have been resumed from {fit_store.path}.')
+                if self.args.fitting_backend == 'batched':
+                    todo = [(i, data[i]) for i in new if any(DGP.name not in fits[i] for DGP in self.DGPs)]
+                    for chunk in self.batches(todo):
+                        submit(fit_batch, chunk, 'batch')
+                        in_flight += 1
+                        for i, _ in chunk:
+                            outstanding[i] += 1
+                else:
+                    tasks = [(i, DGP.name, data[i], fits[i].get(DGP.nested)) for i in new for DGP in self.pending(fits[i])]
+                    remaining = sum(data[i].cost()*len(DGP.bounds) for i in new for DGP in self.DGPs if DGP.name not in fits[i])
+                    target = remaining/(self.cores*chunks_per_core)
+                    for i, *_ in tasks:
+                        outstanding[i] += 1
+                #peptides that were completely resumed are already done
+                complete(new)
+            elif kind == 'batch':
+                in_flight -= 1
+                for i, result in payload:
+                    outstanding[i] -= 1
+                    fits[i] = {DGP.name:r for DGP, r in zip(self.DGPs, result, strict = True)}
+                    if fit_store is not None:
+                        for name, r in fits[i].items():
+                            fit_store.append(keys[i], name, r)
+                complete([i for i, _ in payload])
+            elif kind == 'fit':
+                in_flight -= 1
+                for i, name, result in payload:
+                    outstanding[i] -= 1
+                    fits[i][name] = result
+                    if fit_store is not None:
+                        fit_store.append(keys[i], name, result)
+                    if not self.good_enough(fits[i]):
+                        for DGP in self.dependents(name):
+                            tasks.append((i, DGP.name, data[i], result))
+                            outstanding[i] += 1
+                complete(set(i for i, *_ in payload))
+                self.args.logs.debug(f'{sum(len(f) for f in fits)} models have been fit.')
+            
+            for chunk in self.chunks(tasks, target):
+                submit(fit_chunk, chunk, 'fit')
+                in_flight += 1
+        return peptides, fits
+    
+    def fit_peptides(self, peptides, fit_store = None, prune = True, writer = None):
+        """
+        Fit and select models for a list of peptides, or for an iterable of peptide lists
+        which are fit as they arrive. If a report writer is given each peptide that passes 
+        pruning is written as soon as its models are fit.
+        """
         self.args.logs.info('Peptide model fitting has started.')
-        global all_peptides
-        all_peptides = peptides
+        if isinstance(peptides, list):
+            peptides = [peptides]
+        
+        def on_complete(peptide, fits):
+            peptide.fit_results = self.ordered_results(fits)
+            self.model_selection(peptide)
+            if writer is not None and (not prune or self.keep(peptide)):
+                writer.write([peptide])
         
         with Manager() as manager:
             shared_event = manager.Event()
-            def init_worker(shared_event):
-                global event
-                event = shared_event
-            
             with Pool(processes = self.cores,
                       initializer=init_worker, 
-                      initargs=(shared_event,)) as p:
-                results = p.map(self.fit_all_DGPs, range(len(all_peptides)))
-            
-        for peptide, result in zip(peptides, results, strict = True):
-            peptide.fit_results = result
-        
-        for peptide in peptides:
-            self.model_selection(peptide)
+                      initargs=(shared_event, self.args)) as p:
+                peptides, fits = self.schedule(p, peptides, fit_store, on_complete)
+            if shared_event.is_set():
+                raise RuntimeError('Peptide model fitting failed.')
         
         #prune poorly fitting peptides
-        peptides = self.prune_peptides(peptides)
+        if prune:
+            peptides = self.prune_peptides(peptides)
         
         self.args.logs.info(f'Models have been fit to {len(peptides)} peptides.')
         return peptides
-
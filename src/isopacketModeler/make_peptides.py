@@ -6,17 +6,40 @@ Created on Thu Mar 21 17:02:02 2024
 @author: 4vt
 """
 
+import hashlib
 from collections import defaultdict
+
 from isopacketModeler.data_objects import peptide
 
 def fingerprint(psm):
     return (psm.raw_sequence, psm.file)
 
+def peptide_fingerprint(peptide):
+    #every PSM of a peptide shares its fingerprint
+    return fingerprint(peptide.psms[0])
+
+def shard_of(key, n_shards):
+    #python's hash() is salted per process so a content hash keeps shards identical across jobs
+    digest = hashlib.blake2b(repr(key).encode(), digest_size = 8).digest()
+    return int.from_bytes(digest, 'big')%n_shards + 1
+
+def shard_peptides(args, peptides):
+    """Keep the peptides in this job's shard from a list of peptides or from an iterable of peptide lists."""
+    index, n_shards = args.shard
+    def keep(batch):
+        return [p for p in batch if shard_of(peptide_fingerprint(p), n_shards) == index]
+    if not isinstance(peptides, list):
+        return (keep(batch) for batch in peptides)
+    peptides = keep(peptides)
+    args.logs.info(f'{len(peptides)} Peptides are in shard {index} of {n_shards}.')
+    return peptides
+
 def initialize_peptides(args, psms, bad_psms):
     psm_lists = defaultdict(lambda:[])
     for psm in psms:
         psm_lists[fingerprint(psm)].append(psm)
     
+    #bad PSMs are only kept if they share a fingerprint with a good PSM
     good_fingerprints = set(psm_lists.keys())
     for psm in bad_psms:
         this_fingerprint = fingerprint(psm)
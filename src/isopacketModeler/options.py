@@ -8,6 +8,7 @@ Created on Fri Mar 22 15:03:53 2024
 
 from argparse import ArgumentParser
 import tomllib
+import importlib.util
 import os
 import logging
 
@@ -62,17 +63,49 @@ class options:
                                 help = 'Whether to overwrite existing outputs')
         cmd_parser.add_argument('--classifier_fdr', action = 'store', required = False, default = 0.05, type = float,
                                 help = 'The false discovery rate target for the PSM classifier')
+        cmd_parser.add_argument('--classifier_tolerance', action = 'store', required = False, default = 0.01, type = float,
+                                help = 'Stop training the PSM classifier when the mean change of its labels is below this')
+        cmd_parser.add_argument('--classifier_patience', action = 'store', required = False, default = 2, type = int,
+                                help = 'Epochs without improvement in validation loss before a classifier training round stops')
         cmd_parser.add_argument('--data_generating_processes', action = 'append', required = True, choices = ['BetabinomQuiescentMix',
 			                                                                                                  'Betabinom',
    		                                                                                                      'BinomQuiescentMix',
                                                                                                               'Binom'],
                                 help = 'Use once for each model to fit to peptide data')
+        cmd_parser.add_argument('--fitting_backend', action = 'store', required = False, default = 'basinhopping', choices = ['basinhopping', 'batched'],
+                                help = 'Fit peptides one at a time with basinhopping or many at once with a vectorized population search')
+        cmd_parser.add_argument('--fit_patience', action = 'store', required = False, type = int, default = 20,
+                                help = 'Stop a basinhopping run after this many iterations without a new best fit, 0 to always run every iteration')
+        cmd_parser.add_argument('--reweight_tolerance', action = 'store', required = False, type = float, default = 0.01,
+                                help = 'Skip the reweighted refit when the residual weights vary by less than this')
         cmd_parser.add_argument('--max_peptide_err', action = 'store', required = False, type = float, default = 0.015,
                                 help = 'Peptides with model fit error above this value will not be reported')
+        cmd_parser.add_argument('--skip_models_below', action = 'store', required = False, type = float, default = 0,
+                                help = 'Stop fitting models to a peptide once one fits with an error below this fraction of max_peptide_err, 0 to fit every model')
         cmd_parser.add_argument('--do_psm_classification', action = 'store_true', required=False, default=False,
                                 help = 'Whether to do a preliminary classification of isotope enrichment')
+        cmd_parser.add_argument('--classifier_model', action = 'store', required = False, default = False,
+                                help = 'A psm_classifier directory from a previous run to use instead of training a new classifier')
         cmd_parser.add_argument('--checkpoint_files', action = 'append', required = False, default = [],
                                 help = 'Use once per checkpoint file, all checkpoints must be at the same step')
+        cmd_parser.add_argument('--read_all_ms1s', action = 'store_false', dest = 'stream_mzml', required = False, default = True,
+                                help = 'Decode every MS1 scan rather than only those near a PSM')
+        cmd_parser.add_argument('--ms1_cache_directory', action = 'store', required = False, default = None,
+                                help = 'Directory to cache decoded MS1 data in for reuse by later runs; defaults to ms1_cache/ within the output directory')
+        cmd_parser.add_argument('--no_ms1_cache', action = 'store_const', const = False, dest = 'ms1_cache_directory', required = False,
+                                help = 'Do not read or write the MS1 cache')
+        cmd_parser.add_argument('--parallel_mzml', action = 'store', required = False, default = 2, type = int,
+                                help = 'The number of mzML files to read at the same time')
+        cmd_parser.add_argument('--mzml_memory_limit', action = 'store', required = False, default = 0, type = float,
+                                help = 'The approximate number of GB of MS1 data to hold in memory at once, 0 means no limit')
+        cmd_parser.add_argument('--stream_checkpoints', action = 'store_true', required = False, default = False,
+                                help = 'Start fitting peptides from step 2 checkpoints while later checkpoint files are still loading')
+        cmd_parser.add_argument('--shard', action = 'store', required = False, default = False,
+                                help = 'Fit only shard i of N of the peptides, given as i/N with i from 1 to N')
+        cmd_parser.add_argument('--merge_shards', action = 'append', required = False, default = [],
+                                help = 'Use once per shard output file to merge shards into the final report, globs are allowed')
+        cmd_parser.add_argument('--parquet_report', action = 'store_true', required = False, default = False,
+                                help = 'Also write the results to peptides.parquet, this requires pyarrow')
         cmd_parser.add_argument('--stopping_point', action = 'store', required = False, default = False, type = int, choices = [1,2],
                                 help = 'What step to stop at if you wish to stop early')
         args = parser.parse_args()
@@ -128,9 +161,52 @@ class options:
             msg = 'Required settings not found in options file:\n' + '\n'.join(problems)
             self.logs.error(msg)
             raise InputError()
+        #optional settings take these values when they are not specified
+        defaults = {'classifier_fdr':0.05,
+                    'classifier_tolerance':0.01,
+                    'classifier_patience':2,
+                    'checkpoint_files':[],
+                    'stopping_point':False,
+                    'stream_mzml':True,
+                    'ms1_cache_directory':f'{self.output_directory}ms1_cache/',
+                    'parallel_mzml':2,
+                    'mzml_memory_limit':0,
+                    'fitting_backend':'basinhopping',
+                    'fit_patience':20,
+                    'reweight_tolerance':0.01,
+                    'skip_models_below':0,
+                    'stream_checkpoints':False,
+                    'shard':False,
+                    'merge_shards':[],
+                    'parquet_report':False,
+                    'classifier_model':False}
+        for setting, value in defaults.items():
+            if not setting in self.__dict__.keys():
+                setattr(self, setting, value)
+        if self.parallel_mzml < 1:
+            self.logs.error(f'parallel_mzml must be at least 1, got {self.parallel_mzml}')
+            raise InputError()
+        if self.shard:
+            self.parse_shard()
+        if self.classifier_model and not os.path.exists(self.classifier_model):
+            self.logs.error(f'The classifier model {self.classifier_model} does not exist.')
+            raise InputError()
+        if self.parquet_report and importlib.util.find_spec('pyarrow') is None:
+            self.logs.error('parquet_report is true but pyarrow is not installed.')
+            raise InputError()
         if type(self.psm_headers) == str:
             self.psm_headers = self.psm_headers.split(',')
             
+    def parse_shard(self):
+        try:
+            index, n_shards = (int(v) for v in str(self.shard).split('/'))
+        except ValueError:
+            index, n_shards = 0, 0
+        if not 1 <= index <= n_shards:
+            self.logs.error(f'shard must be given as i/N with 1 <= i <= N, got {self.shard}')
+            raise InputError()
+        self.shard = (index, n_shards)
+    
     def find_mzml(self):
         mzml_files = [f for f in os.listdir(self.mzml_dir) if f.lower().endswith('.mzml')]
         self.mzml_files = [os.path.join(self.mzml_dir, f) for f in mzml_files]
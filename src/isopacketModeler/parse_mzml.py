@@ -6,17 +6,18 @@ Created on Thu Mar 21 14:51:10 2024
 @author: 4vt
 """
 
-from multiprocessing import Pool, Manager
-import traceback
+from multiprocessing import Pool, resource_tracker
 from copy import copy
-import sys
+from collections import defaultdict
+import queue
+import re
+import os
+import hashlib
 
 import pandas as pd
 import numpy as np
-import pyopenms as oms
-from sortedcontainers import SortedList
 
-from isopacketModeler.data_objects import psm, base_name, Scan
+from isopacketModeler.data_objects import psm, base_name, Scan, ScanStore, clean_seq, calc_theory
 
 # parse PSM files into a list of data tuples
 def parse_PSMs(args):
@@ -42,7 +43,7 @@ def parse_PSMs(args):
     
     #add arbitrary columns listed in the optios file as a metadata dictionary
     if len(args.psm_headers) > 5:
-        psm_metadata = [{k:v for k,v in zip(d[1].keys(), d[1].values, strict = True)} for d in psm_data[args.psm_headers[5:]].iterrows()]
+        psm_metadata = psm_data[args.psm_headers[5:]].to_dict('records')
     else:
         psm_metadata = [{}]*psm_data.shape[0]
     psm_data['psm_metadata'] = psm_metadata
@@ -57,9 +58,9 @@ def initialize_psms(args, psm_data):
     design_data = copy(args.design)
     design_data.index = [base_name(f) for f in design_data['file']]
 
-    #add design metadata dictionaries to PSMs    
-    metadata = design_data.loc[[base_name(f) for f in psm_data['file']]]
-    psm_data['design_metadata'] = [{k:v for k,v in zip(d[1].keys(), d[1].values, strict = True)} for d in metadata.iterrows()]
+    #add design metadata dictionaries to PSMs, PSMs from the same file share one dictionary
+    design_metadata = dict(zip(design_data.index, design_data.to_dict('records'), strict = True))
+    psm_data['design_metadata'] = [design_metadata[base_name(f)] for f in psm_data['file']]
     psm_data['label'] = [m['label'] for m in psm_data['design_metadata']]
     psm_data['is_labeled'] = [bool(l) for l in psm_data['label']]
     
@@ -77,43 +78,225 @@ def initialize_psms(args, psm_data):
         psm_data.append(temp)
     psm_data = pd.concat(psm_data)
     
+    #compute theoretical packets once per unique peptide ion and share them between PSMs
+    keys = list(zip([clean_seq(s) for s in psm_data['raw_sequence']], psm_data['charge'], psm_data['label'], strict = True))
+    unique_keys = list(set(keys))
+    with Pool(args.cores) as p:
+        theories = p.starmap(calc_theory, 
+                             [(*k, args.aa_formulae) for k in unique_keys], 
+                             chunksize = max(1, len(unique_keys)//(args.cores*4)))
+    theories = dict(zip(unique_keys, theories, strict = True))
+    args.logs.debug(f'Theoretical isotope packets were calculated for {len(unique_keys)} unique peptide ions.')
+    
     # instantiate PSM objects
-    psms = [psm(**d[1], args = args) for d in psm_data.iterrows()]
+    psms = [psm(**d, args = args, theory = theories[k]) for d, k in zip(psm_data.to_dict('records'), keys, strict = True)]
     args.logs.info(f'{len(psms)} PSM objects have been initialized.')
     return psms
 
-def read_mzml(file):
+def scan_number(spectrum):
+    return int(re.search(r'scan=(\d+)', spectrum.getNativeID()).group(1))
+
+def needed_ms1s(ms1_scans, psm_scans, width = 3):
+    #positions of every MS1 within the extraction window of at least one PSM
+    centers = np.searchsorted(ms1_scans, psm_scans, side = 'left')
+    positions = (centers[:, np.newaxis] + np.arange(-width, width + 1)[np.newaxis, :]).flatten()
+    positions = positions[np.logical_and(positions >= 0, positions < len(ms1_scans))]
+    return np.unique(positions)
+
+def ms1_index(od_exp):
+    #find MS1s from the spectrum metadata so that no peak data is decoded
+    spectra = od_exp.getMetaData().getSpectra()
+    ms1_idx = [i for i, s in enumerate(spectra) if s.getMSLevel() == 1]
+    ms1_scans = np.array([scan_number(spectra[i]) for i in ms1_idx], dtype = np.int64)
+    order = np.argsort(ms1_scans, kind = 'stable')
+    return np.asarray(ms1_idx, dtype = np.int64)[order], ms1_scans[order]
+
+class MS1Cache:
+    """
+    An on-disk copy of the MS1 index and the decoded MS1 peaks of one mzML file, keyed by its resolved path.
+    Entries are reused when the file size and modification time are unchanged, 
+    or failing that when the file content hash matches.
+    """
+    def __init__(self, mzml, cache_directory):
+        self.mzml = mzml
+        self.cache_directory = cache_directory
+        #files with the same name in different directories get their own entries
+        location = hashlib.blake2b(os.path.realpath(mzml).encode(), digest_size = 8).hexdigest()
+        self.path = os.path.join(cache_directory, f'{base_name(mzml)}.{location}.ms1cache.npz')
+        #the content hash of the file at a given (size, mtime), so that the file is hashed at most once
+        self.known_hash = (None, None)
+    
+    def content_hash(self, stat):
+        key = (stat.st_size, stat.st_mtime_ns)
+        if self.known_hash[0] != key:
+            digest = hashlib.blake2b()
+            with open(self.mzml, 'rb') as mzml:
+                for chunk in iter(lambda: mzml.read(2**24), b''):
+                    digest.update(chunk)
+            self.known_hash = (key, digest.hexdigest())
+        return self.known_hash[1]
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        stat = os.stat(self.mzml)
+        with np.load(self.path) as cache:
+            entry = {k:cache[k] for k in cache.files}
+        if entry['size'] != stat.st_size:
+            return None
+        if entry['mtime'] == stat.st_mtime_ns:
+            #the stored hash still describes the file and is kept when the entry is rewritten
+            self.known_hash = ((stat.st_size, stat.st_mtime_ns), str(entry['hash']))
+        elif str(entry['hash']) != self.content_hash(stat):
+            return None
+        store = ScanStore(entry['scans'], entry['offsets'], entry['mz'], entry['i'])
+        return entry['ms1_idx'], entry['ms1_scans'], store
+    
+    def save(self, ms1_idx, ms1_scans, store):
+        os.makedirs(self.cache_directory, exist_ok = True)
+        stat = os.stat(self.mzml)
+        #write to a temporary file first so that a partially written cache is never read
+        tmp_path = f'{self.path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path,
+                 size = stat.st_size,
+                 mtime = stat.st_mtime_ns,
+                 hash = self.content_hash(stat),
+                 ms1_idx = ms1_idx,
+                 ms1_scans = ms1_scans,
+                 scans = store.scans,
+                 offsets = store.offsets,
+                 mz = store.mz,
+                 i = store.i)
+        os.replace(tmp_path, self.path)
+
+def open_mzml(file):
+    #pyopenms is only needed to decode spectra so it is imported when the first file is opened
+    import pyopenms as oms
     od_exp = oms.OnDiscMSExperiment()
     od_exp.openFile(file)
-    ms1s = []
-    for i in range(od_exp.getNrSpectra()):
-        spectrum = od_exp.getSpectrum(i)
-        if spectrum.getMSLevel() == 1:
-            ms1s.append(Scan(spectrum))
-    ms1s = SortedList(ms1s, key = lambda s: s.scan)
-    return ms1s
+    return od_exp
+
+def read_mzml(file, psm_scans = None, cache_directory = None):
+    cache = MS1Cache(file, cache_directory) if cache_directory else None
+    cached = cache.load() if cache is not None else None
+    od_exp = None
+    if cached is None:
+        od_exp = open_mzml(file)
+        ms1_idx, ms1_scans = ms1_index(od_exp)
+        decoded = ScanStore.from_scans([])
+    else:
+        ms1_idx, ms1_scans, decoded = cached
+    
+    if psm_scans is not None:
+        keep = needed_ms1s(ms1_scans, np.asarray(psm_scans), width = 3)
+    else:
+        keep = np.arange(len(ms1_scans))
+    
+    #only decode the spectra that are not already available from the cache
+    missing = keep[np.isin(ms1_scans[keep], decoded.scans, invert = True)]
+    if len(missing):
+        if od_exp is None:
+            od_exp = open_mzml(file)
+        new_scans = [Scan(int(ms1_scans[k]), *od_exp.getSpectrum(int(ms1_idx[k])).get_peaks()) for k in missing]
+        decoded = ScanStore.from_scans([decoded[k] for k in range(len(decoded))] + new_scans)
+        if cache is not None:
+            cache.save(ms1_idx, ms1_scans, decoded)
+    return decoded.select(np.searchsorted(decoded.scans, ms1_scans[keep]))
 
 # parse mzML files
-def process_psm(psm):
-    scan_idx = ms1s.bisect_left(psm)
-    scans = ms1s[scan_idx - 3: scan_idx + 4]
+def load_ms1s(mzml, psm_scans, cache_directory):
+    #runs in a reader process, the scans are left in shared memory for the matching workers
+    store = read_mzml(mzml, psm_scans, cache_directory).share()
+    handle = store.handle
+    nbytes = store.nbytes
+    store.close()
+    return mzml, handle, nbytes
+
+def release_ms1s(handle):
+    store = ScanStore.attach(handle)
+    store.close()
+    store.unlink()
+
+def process_psm(psm, ms1s):
+    scans = ms1s.neighbourhood(psm.scan)
     psm.parse_scans(scans)
     return psm if psm.is_useable() else None
 
+def process_psms(psms, handle):
+    ms1s = ScanStore.attach(handle)
+    try:
+        return [process_psm(psm, ms1s) for psm in psms]
+    finally:
+        ms1s.close()
+
 def process_spectrum_data(args, psms):
-    PSM_list = psms
-    result_psms = []
-    global ms1s
-    for mzml in args.mzml_files:
-        ms1s = read_mzml(mzml)
+    file_psms = defaultdict(lambda:[])
+    for psm in psms:
+        file_psms[psm.base_name].append(psm)
+    pending = [f for f in args.mzml_files if file_psms[base_name(f)]]
+    memory_limit = args.mzml_memory_limit*1e9
+    file_results = {}
+    #bytes of MS1 data per file that is being read or is held in shared memory
+    resident = {}
+    loaded = {}
+    events = queue.Queue()
+    
+    def read_file(mzml):
         no_extension = base_name(mzml)
-        subset_psms = [p for p in PSM_list if p.base_name == no_extension]
-        args.logs.debug(f'There are {len(subset_psms)} PSMs in file {no_extension}')
-
-        with Pool(args.cores) as p:
-            result_psms.extend(p for p in p.map(process_psm, subset_psms) if p is not None)
-            
+        args.logs.debug(f'There are {len(file_psms[no_extension])} PSMs in file {no_extension}')
+        psm_scans = [psm.scan for psm in file_psms[no_extension]] if args.stream_mzml else None
+        resident[mzml] = os.path.getsize(mzml)
+        readers.apply_async(load_ms1s, 
+                            (mzml, psm_scans, args.ms1_cache_directory),
+                            callback = lambda r: events.put(('read', r)),
+                            error_callback = lambda e: events.put(('error', e)))
+    
+    def match_file(mzml, handle):
+        subset_psms = file_psms[base_name(mzml)]
+        chunksize = max(1, len(subset_psms)//(args.cores*4))
+        chunks = [(subset_psms[i:i+chunksize], handle) for i in range(0, len(subset_psms), chunksize)]
+        workers.starmap_async(process_psms, 
+                              chunks,
+                              chunksize = 1,
+                              callback = lambda r: events.put(('matched', (mzml, r))),
+                              error_callback = lambda e: events.put(('error', e)))
+    
+    #start the resource tracker before forking so that all workers share it
+    resource_tracker.ensure_running()
+    with Pool(args.parallel_mzml) as readers, Pool(args.cores) as workers:
+        try:
+            while pending or resident:
+                #read ahead while previously read files are being matched, within the memory budget
+                while pending and sum(1 for f in resident if f not in loaded) < args.parallel_mzml:
+                    if resident and memory_limit and sum(resident.values()) + os.path.getsize(pending[0]) > memory_limit:
+                        break
+                    read_file(pending.pop(0))
+                
+                event, data = events.get()
+                if event == 'error':
+                    raise data
+                elif event == 'read':
+                    mzml, handle, nbytes = data
+                    args.logs.debug(f'{handle[1]} MS1 scans were read from file {base_name(mzml)}')
+                    loaded[mzml] = handle
+                    resident[mzml] = nbytes
+                    match_file(mzml, handle)
+                elif event == 'matched':
+                    mzml, results = data
+                    file_results[mzml] = [psm for chunk in results for psm in chunk if psm is not None]
+                    release_ms1s(loaded.pop(mzml))
+                    del resident[mzml]
+        finally:
+            #unlink any scans left in shared memory by an error
+            readers.terminate()
+            while not events.empty():
+                event, data = events.get()
+                if event == 'read':
+                    loaded[data[0]] = data[1]
+            for handle in loaded.values():
+                release_ms1s(handle)
+    
+    result_psms = [psm for mzml in args.mzml_files for psm in file_results.get(mzml, [])]
     args.logs.debug('Intensity data for PSMs have been extracted from mzML files.')
     args.logs.info(f'{len(result_psms)} PSMs have passed the initial usability filter.')
     return result_psms
-
@@ -7,23 +7,28 @@ Created on Thu Mar 21 16:50:17 2024
 """
 
 
-import matplotlib.pyplot as plt
-from matplotlib import cm
+from functools import cache
 
 import numpy as np
 
-plt.rcParams.update({
-    "text.usetex": True,
-    "font.family": "Helvetica"
-})
-
+@cache
+def pyplot():
+    #matplotlib is only imported when something is plotted
+    import matplotlib.pyplot as plt
+    plt.rcParams.update({
+        "text.usetex": True,
+        "font.family": "Helvetica"
+    })
+    return plt
 
 def get_colors(vals):
     low = min(vals)
     high = max(vals)
-    return [cm.plasma(int(((val-low)/(high-low))*cm.plasma.N)) for val in vals]
+    plasma = pyplot().cm.plasma
+    return [plasma(int(((val-low)/(high-low))*plasma.N)) for val in vals]
 
 def get_sm(vals):
+    plt = pyplot()
     colormap = plt.cm.get_cmap('plasma')
     sm = plt.cm.ScalarMappable(cmap=colormap)
     sm.set_clim(vmin = min(vals), vmax = max(vals))
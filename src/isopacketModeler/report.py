@@ -6,16 +6,239 @@ Created on Fri Dec 13 14:08:53 2024
 @author: 4vt
 """
 
+import glob
+import sys
+import csv
+
 import dill
+import numpy as np
 import pandas as pd
 
-def make_report(args, peptides):
+from isopacketModeler.fit_controller import peptide_fit_conroller, data_generating_processes
+from isopacketModeler.data_generating_processes import results
+
+def psm_metadata_columns(args):
+    """
+    Maps each PSM metadata key to its report column. Numeric columns of the PSM files are averaged 
+    and other columns are listed, which is decided up front so that every report has the same columns.
+    """
+    columns = {}
+    keys = args.psm_headers[5:]
+    if keys:
+        metadata = pd.concat([pd.read_csv(f, sep = '\t', usecols = keys) for f in args.psms])
+        for key in keys:
+            kind = 'mean' if pd.api.types.is_numeric_dtype(metadata[key]) else 'unique'
+            columns[key] = f'PSMs_{kind}_{key}'
+    if args.do_psm_classification:
+        columns['classifier_qvalue'] = 'PSMs_mean_classifier_qvalue'
+    return columns
+
+class ReportWriter:
+    """
+    Appends rows to peptides.tsv as peptides are finished. The columns are fixed by the 
+    configured models, the design, the PSM metadata headers and the reported fit fields.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.path = f'{args.output_directory}peptides.tsv'
+        self.columns = None
+        self.metadata_columns = psm_metadata_columns(args)
+        self.rows = 0
+        self.file = None
+        self.columnar = ColumnarReportWriter(args, metadata_columns = self.metadata_columns) if args.parquet_report else None
+    
+    def schema(self):
+        columns = ['peptide', 'proteins', 'npeaks']
+        columns.extend(self.args.design.columns)
+        columns.append('PSM_count')
+        columns.extend(self.metadata_columns.values())
+        stats = list(results.report_fields)
+        DGPs = [data_generating_processes[d](self.args) for d in self.args.data_generating_processes]
+        columns.append('canonical_DGP')
+        columns.extend(f'canonical_{s}' for s in stats)
+        columns.extend(f'canonical_param{i}' for i in range(max(len(d.bounds) for d in DGPs)))
+        for DGP in DGPs:
+            columns.extend(f'{DGP.name}_{s}' for s in stats)
+            columns.extend(f'{DGP.name}_param{i}' for i in range(len(DGP.bounds)))
+        return columns
+    
+    def open(self):
+        self.columns = self.schema()
+        self.file = open(self.path, 'w', newline = '')
+        self.writer = csv.writer(self.file, delimiter = '\t')
+        self.writer.writerow(self.columns)
+    
+    def format(self, value):
+        #missing values are left empty
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return ''
+        return value
+    
+    def write(self, peptides):
+        if not peptides:
+            return
+        if self.file is None:
+            self.open()
+        for peptide in peptides:
+            fields = peptide.report(self.metadata_columns)
+            self.writer.writerow([self.format(fields.get(c)) for c in self.columns])
+        self.file.flush()
+        self.rows += len(peptides)
+        if self.columnar is not None:
+            self.columnar.write(peptides)
+    
+    def close(self):
+        if self.file is None:
+            self.open()
+        self.file.close()
+        self.args.logs.debug(f'{self.rows} peptides have been written to {self.path}.')
+        if self.columnar is not None:
+            self.columnar.close()
+
+class ColumnarReportWriter(ReportWriter):
+    """
+    Writes the report columns to peptides.parquet along with each peptide's obs and mz_err 
+    matrices and the fitted distributions as list columns. Rows are buffered and written as row groups.
+    """
+    def __init__(self, args, row_group_size = 1024, metadata_columns = None):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.args = args
+        self.path = f'{args.output_directory}peptides.parquet'
+        self.row_group_size = row_group_size
+        self.columns = None
+        self.metadata_columns = psm_metadata_columns(args) if metadata_columns is None else metadata_columns
+        self.rows = 0
+        self.buffer = []
+        self.file = None
+    
+    def column_type(self, column):
+        pa = self.pa
+        if column in self.args.design.columns:
+            dtype = self.args.design[column].dtype
+            if pd.api.types.is_bool_dtype(dtype):
+                return pa.bool_()
+            return pa.float64() if pd.api.types.is_numeric_dtype(dtype) else pa.string()
+        if column in ('peptide', 'proteins', 'canonical_DGP') or column.startswith('PSMs_unique_'):
+            return pa.string()
+        if column in ('npeaks', 'PSM_count'):
+            return pa.int64()
+        field = self.fit_fields.get(column)
+        if field is not None:
+            return {float:pa.float64(), int:pa.int64(), bool:pa.bool_()}[field]
+        return pa.float64()
+    
+    def open(self):
+        pa = self.pa
+        self.columns = self.schema()
+        prefixes = ['canonical'] + list(self.args.data_generating_processes)
+        self.fit_fields = {f'{p}_{k}':t for p in prefixes for k,t in results.report_fields.items()}
+        fields = [pa.field(c, self.column_type(c)) for c in self.columns]
+        fields.extend(pa.field(c, pa.list_(pa.list_(pa.float64()))) for c in ('obs', 'mz_err'))
+        self.dist_columns = ['canonical_fitted_dist']
+        self.dist_columns.extend(f'{d}_fitted_dist' for d in self.args.data_generating_processes)
+        fields.extend(pa.field(c, pa.list_(pa.float64())) for c in self.dist_columns)
+        self.arrow_schema = pa.schema(fields)
+        self.file = self.pq.ParquetWriter(self.path, self.arrow_schema)
+    
+    def format(self, value, kind):
+        #missing values are stored as nulls
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if kind == self.pa.string():
+            return str(value)
+        return value
+    
+    def row(self, peptide):
+        fields = peptide.report(self.metadata_columns)
+        row = {c:self.format(fields.get(c), self.column_type(c)) for c in self.columns}
+        row['obs'] = np.asarray(peptide.obs, dtype = float).tolist()
+        row['mz_err'] = np.asarray(peptide.mz_err, dtype = float).tolist()
+        fits = {f'{f.dgp_name}_fitted_dist':f for f in peptide.fit_results}
+        fits['canonical_fitted_dist'] = peptide.canonical_fit
+        for col in self.dist_columns:
+            fit = fits.get(col)
+            row[col] = None if fit is None else np.asarray(fit.fitted_dist, dtype = float).tolist()
+        return row
+    
+    def flush(self):
+        if self.buffer:
+            table = self.pa.Table.from_pylist(self.buffer, schema = self.arrow_schema)
+            self.file.write_table(table)
+            self.buffer = []
+    
+    def write(self, peptides):
+        if not peptides:
+            return
+        if self.file is None:
+            self.open()
+        self.buffer.extend(self.row(p) for p in peptides)
+        self.rows += len(peptides)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+    
+    def close(self):
+        if self.file is None:
+            self.open()
+        self.flush()
+        self.file.close()
+        self.args.logs.debug(f'{self.rows} peptides have been written to {self.path}.')
+
+def make_report(args, peptides, writer = None):
     #serialize peptide objects
     with open(f'{args.output_directory}peptides.dill', 'wb') as dillfile:
         dill.dump(peptides, dillfile)
     args.logs.debug(f'{len(peptides)} peptides have been saved.')
     
-    #make fitted peptide table
-    report = pd.DataFrame([p.report() for p in peptides])
-    report.to_csv(f'{args.output_directory}peptides.tsv', sep = '\t', index = False)
+    #make fitted peptide table, unless its rows were written during fitting
+    if writer is None:
+        writer = ReportWriter(args)
+        writer.write(peptides)
+    writer.close()
+    
+
+def dump_shard(args, peptides):
+    #peptides are saved unpruned so that pruning is applied once to the merged shards
+    index, n_shards = args.shard
+    shard_file = f'{args.output_directory}peptides_shard{index}of{n_shards}.dill'
+    with open(shard_file, 'wb') as dillfile:
+        dill.dump((args.shard, peptides), dillfile)
+    args.logs.info(f'{len(peptides)} peptides from shard {index} of {n_shards} have been saved to {shard_file}.')
+
+def merge_shards(args):
+    shard_files = []
+    for file in args.merge_shards:
+        if '*' in file:
+            shard_files.extend(glob.glob(file))
+        else:
+            shard_files.append(file)
+    
+    shards = {}
+    shard_peptides = {}
+    for shard_file in shard_files:
+        args.logs.debug(f'Now loading shard file {shard_file}')
+        with open(shard_file, 'rb') as dillfile:
+            shard, peptides = dill.load(dillfile)
+        if shard in shards:
+            args.logs.error(f'Shard {shard[0]} of {shard[1]} was found in both {shards[shard]} and {shard_file}.')
+            sys.exit(1)
+        shards[shard] = shard_file
+        shard_peptides[shard] = peptides
+    peptides = [p for shard in sorted(shard_peptides) for p in shard_peptides[shard]]
+    
+    n_shards = set(n for _, n in shards)
+    if not shards:
+        args.logs.error('No shard files were found to merge.')
+        sys.exit(1)
+    elif len(n_shards) != 1:
+        args.logs.error('Shards from different numbers of shards detected. Please only merge shards from one run.')
+        sys.exit(1)
+    missing = set(range(1, next(n for n in n_shards) + 1)) - set(i for i, _ in shards)
+    if missing:
+        args.logs.warning(f'Shards {sorted(missing)} are missing, their peptides will not be reported.')
     
+    peptides = peptide_fit_conroller(args).prune_peptides(peptides)
+    args.logs.info(f'{len(peptides)} peptides have been merged from {len(shards)} shards.')
+    return peptides
@@ -14,11 +14,11 @@ import warnings
 import numpy as np
 import pandas as pd
 from brainpy import isotopic_variants
-from sortedcontainers import SortedList
+from scipy.optimize import approx_fprime
 
 from isopacketModeler.options import options
 from isopacketModeler.parse_mzml import initialize_psms, process_psm, process_spectrum_data, read_mzml
-from isopacketModeler.data_objects import peptide
+from isopacketModeler.data_objects import peptide, Scan, ScanStore
 
 
 class ParsedOptionsTestSuite(unittest.TestCase):
@@ -70,18 +70,13 @@ class ProcessedPSMsTestSuite(InitializedPSMsTestSuite):
         mz = [p.mz for p in spectrum]
         intensity = [p.intensity for p in spectrum]
         #construct ms1 list
-        class mock_ms1():
-            def __init__(self):
-                self.i = intensity
-                self.mz = mz
-        ms1s = SortedList([(i, mock_ms1()) for i in range(20)])
+        ms1s = ScanStore.from_scans([Scan(i, mz, intensity) for i in range(20)])
 
-        def read_mzml(file):
+        def read_mzml(file, psm_scans = None, cache_directory = None):
             return ms1s
         
         #inject our mocked data into the namespace of the function
         process_psm.__globals__['read_mzml'] = read_mzml
-        process_psm.__globals__['PSM_list'] = PSM_list
         process_spectrum_data.__globals__['process_psm'] = process_psm
         
         with warnings.catch_warnings():
@@ -135,5 +130,54 @@ class DataGeneratingProcessTestSuite(InitializedPSMsTestSuite):
         for truth, fitted in zip(self.reasonable_params, pep.fit_results[0].params, strict = True):
             with self.subTest('test that parameters are recovered'):
                 self.assertAlmostEqual(truth, fitted, delta = 0.001)
+    
+    def test_loss_gradient_matches_finite_differences(self):
+        for psm in self.psms:
+            psm.intensity = self.rng.uniform(1e5,1e7,len(psm.mz))
+            ppm5 = (psm.mz[0]/1e6)*5
+            psm.mz_err = self.rng.uniform(-ppm5,ppm5,len(psm.mz))
+        pep = peptide(self.psms)
+        for weights in [1, self.rng.uniform(0.5,1,pep.obs.shape)]:
+            self.DGP.weights = weights
+            fun, grad = self.DGP.loss_and_grad(self.reasonable_params, pep)
+            with self.subTest('test that the loss matches'):
+                self.assertAlmostEqual(fun, self.DGP.loss(self.reasonable_params, pep))
+            numerical = approx_fprime(self.reasonable_params, self.DGP.loss, 1e-7, pep)
+            for analytic, approx in zip(grad, numerical, strict = True):
+                with self.subTest('test that the gradient matches'):
+                    self.assertAlmostEqual(analytic, approx, delta = 1e-4)
+    
+    def test_loss_is_nan_without_observations(self):
+        for psm in self.psms:
+            psm.intensity = self.rng.uniform(1e5,1e7,len(psm.mz))
+            ppm5 = (psm.mz[0]/1e6)*5
+            psm.mz_err = self.rng.uniform(-ppm5,ppm5,len(psm.mz))
+        pep = peptide(self.psms)
+        pep.obs = np.full(pep.obs.shape, np.nan)
+        self.DGP.weights = 1
+        fun, grad = self.DGP.loss_and_grad(self.reasonable_params, pep)
+        with self.subTest('test that both losses are NaN'):
+            self.assertTrue(np.isnan(fun))
+            self.assertTrue(np.isnan(self.DGP.loss(self.reasonable_params, pep)))
+        with self.subTest('test that the gradient is NaN'):
+            self.assertTrue(np.all(np.isnan(grad)))
+    
+    def test_batched_fit_is_good_on_DGPs_own_expected_data(self):
+        for psm in self.psms:
+            psm.intensity = self.rng.uniform(1e5,1e7,len(psm.mz))
+            ppm5 = (psm.mz[0]/1e6)*5
+            psm.mz_err = self.rng.uniform(-ppm5,ppm5,len(psm.mz))
+        peps = [peptide(self.psms) for _ in range(3)]
+        for pep in peps:
+            pep.obs = np.array([self.DGP.expected(pep, self.reasonable_params)]*len(self.psms))
+        fits = self.DGP.fit_batch(peps)
+        with self.subTest('ensure that each peptide gets a result'):
+            self.assertEqual(len(fits), len(peps))
+        for fit in fits:
+            with self.subTest('test that fit is good'):
+                self.assertLess(fit.fit, 0.01)
+            for truth, fitted in zip(self.reasonable_params, fit.params, strict = True):
+                with self.subTest('test that parameters are recovered'):
+                    self.assertAlmostEqual(truth, fitted, delta = 0.001)
         
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for checkpoint directories and the step 3 fit store.
+"""
+
+import os
+import glob
+import time
+import unittest
+
+import numpy as np
+
+from isopacketModeler.checkpoint import FitStore, Checkpointer
+from isopacketModeler.make_peptides import initialize_peptides
+import base_test_classes
+
+class CheckpointerTestSuite(base_test_classes.ProcessedPSMsTestSuite):
+    def load(self, step):
+        self.args.checkpoint_files = glob.glob(f'{self.args.output_directory}checkpoint_step{step}_*')
+        return Checkpointer(self.args)
+    
+    def test_psms_round_trip(self):
+        Checkpointer(self.args).dump(self.psms, 1)
+        checkpointer = self.load(1)
+        with self.subTest('is the step recovered'):
+            self.assertEqual(checkpointer.load_step, 1)
+        for old, new in zip(self.psms, checkpointer.data, strict = True):
+            with self.subTest('are PSMs recovered'):
+                self.assertEqual(old.raw_sequence, new.raw_sequence)
+                self.assertEqual(old.design_metadata, new.design_metadata)
+                self.assertTrue(np.array_equal(old.intensity, new.intensity, equal_nan = True))
+                self.assertTrue(np.array_equal(old.mz_err, new.mz_err, equal_nan = True))
+    
+    def test_peptides_round_trip(self):
+        peptides = initialize_peptides(self.args, list(self.psms)*2, [])
+        Checkpointer(self.args).dump(peptides, 2)
+        checkpointer = self.load(2)
+        with self.subTest('is the step recovered'):
+            self.assertEqual(checkpointer.load_step, 2)
+        for old, new in zip(peptides, checkpointer.data, strict = True):
+            with self.subTest('are peptides recovered'):
+                self.assertEqual(len(old.psms), len(new.psms))
+                self.assertTrue(np.array_equal(old.obs, new.obs, equal_nan = True))
+
+    def test_peptides_can_be_streamed(self):
+        peptides = initialize_peptides(self.args, self.psms, [])
+        checkpointer = Checkpointer(self.args)
+        checkpointer.dump(peptides[:1], 2)
+        checkpointer.dump(peptides[1:], 2)
+        self.args.stream_checkpoints = True
+        checkpointer = self.load(2)
+        batches = list(checkpointer.data)
+        with self.subTest('is each file yielded separately'):
+            self.assertEqual(len(batches), 2)
+        with self.subTest('are all peptides yielded'):
+            self.assertCountEqual([p.raw_sequence for b in batches for p in b], [p.raw_sequence for p in peptides])
+    
+    def test_streamed_loads_are_bounded(self):
+        peptides = initialize_peptides(self.args, self.psms, [])
+        checkpointer = Checkpointer(self.args)
+        for _ in range(6):
+            checkpointer.dump(peptides, 2)
+        self.args.stream_checkpoints = True
+        self.args.cores = 2
+        checkpointer = self.load(2)
+        started = []
+        load_checkpoint = checkpointer.load_checkpoint
+        checkpointer.load_checkpoint = lambda checkpoint: started.append(checkpoint) or load_checkpoint(checkpoint)
+        next(checkpointer.data)
+        #give the loader threads time to run ahead of the consumer
+        time.sleep(0.5)
+        with self.subTest('are at most cores files loaded ahead'):
+            self.assertLessEqual(len(started), self.args.cores)
+        with self.subTest('are the remaining files still yielded'):
+            self.assertEqual(len(list(checkpointer.data)), 5)
+    
+    def test_incomplete_checkpoints_are_rejected(self):
+        Checkpointer(self.args).dump(self.psms, 1)
+        os.remove(glob.glob(f'{self.args.output_directory}checkpoint_step1_*/header.json')[0])
+        with self.assertRaises(SystemExit):
+            self.load(1)
+
+class FitStoreTestSuite(base_test_classes.ParsedOptionsTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.path = f'{self.args.output_directory}fits.dill'
+    
+    def test_fits_are_resumed(self):
+        store = FitStore(self.path, self.args.logs, resume = False)
+        store.append(('TEST', 'test1.mzML'), 'Binom', 1)
+        store.append(('TEST', 'test1.mzML'), 'Betabinom', 2)
+        store = FitStore(self.path, self.args.logs, resume = True)
+        with self.subTest('are stored fits found'):
+            self.assertEqual(store.get(('TEST', 'test1.mzML')), {'Binom':1, 'Betabinom':2})
+        with self.subTest('are missing peptides empty'):
+            self.assertEqual(store.get(('PEPTIDE', 'test1.mzML')), {})
+    
+    def test_partial_records_are_dropped(self):
+        store = FitStore(self.path, self.args.logs, resume = False)
+        store.append(('TEST', 'test1.mzML'), 'Binom', 1)
+        size = os.path.getsize(self.path)
+        store.append(('TEST', 'test1.mzML'), 'Betabinom', 2)
+        os.truncate(self.path, os.path.getsize(self.path) - 3)
+        store = FitStore(self.path, self.args.logs, resume = True)
+        with self.subTest('is the partial record dropped'):
+            self.assertEqual(store.get(('TEST', 'test1.mzML')), {'Binom':1})
+        with self.subTest('is the file truncated to the last complete record'):
+            self.assertEqual(os.path.getsize(self.path), size)
+        store.append(('TEST', 'test1.mzML'), 'Betabinom', 2)
+        store = FitStore(self.path, self.args.logs, resume = True)
+        with self.subTest('can new records be appended'):
+            self.assertEqual(store.get(('TEST', 'test1.mzML')), {'Binom':1, 'Betabinom':2})
+    
+    def test_fits_are_cleared_without_resume(self):
+        store = FitStore(self.path, self.args.logs, resume = False)
+        store.append(('TEST', 'test1.mzML'), 'Binom', 1)
+        store = FitStore(self.path, self.args.logs, resume = False)
+        self.assertEqual(store.get(('TEST', 'test1.mzML')), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,6 +52,11 @@ class ClassifierTestSuite(base_test_classes.ParsedOptionsTestSuite):
         
         with self.subTest('test FDR is well controlled'):
             self.assertAlmostEqual(test_FDR, target_FDR, delta = 0.03)
+        qvalues = self.model.qvalues(test_targets)
+        with self.subTest('do PSMs above the cutoff have q-values within the FDR'):
+            self.assertTrue(np.all(qvalues[test_targets > self.model.cutoff] <= target_FDR))
+        with self.subTest('do q-values decrease with score'):
+            self.assertTrue(np.all(np.diff(qvalues[np.argsort(test_targets)]) <= 0))
         # with self.subTest('test that the cutoff is close to where it should be'):
         #     self.assertAlmostEqual(self.model.cutoff, target_cutoff, delta = 0.01)
 
@@ -95,6 +100,38 @@ class ClassifierTestSuite(base_test_classes.ParsedOptionsTestSuite):
         calls = self.model.predict(new_obs)
         self.assertLess(np.sum(calls)/len(calls), 0.01)
     
+    def test_training_stops_when_labels_converge(self):
+        data = np.concatenate((self.make_false_data(self.rng), self.make_true_data(self.rng)), axis = 0)
+        label = np.array([0]*self.N + [1]*self.N)
+        self.model.tolerance = 1
+        self.model.fit(data, label)
+        with self.subTest('is only the first round trained'):
+            self.assertEqual(len(self.model.history['epochs']), 1)
+        with self.subTest('is the label change recorded'):
+            self.assertEqual(len(self.model.history['label_change']), 1)
+    
+    def test_degenerate_predictions_do_not_stop_training(self):
+        data = np.concatenate((self.make_false_data(self.rng), self.make_true_data(self.rng)), axis = 0)
+        label = np.array([0]*self.N + [1]*self.N)
+        self.model.tolerance = 1
+        self.model._update_y = lambda X, y_init: None
+        self.model.fit(data, label, niter = 2)
+        with self.subTest('is every round trained'):
+            self.assertEqual(len(self.model.history['epochs']), 3)
+        with self.subTest('is no label change recorded'):
+            self.assertEqual(len(self.model.history['label_change']), 0)
+    
+    def test_saved_model_round_trip(self):
+        data = np.concatenate((self.make_false_data(self.rng), self.make_true_data(self.rng)), axis = 0)
+        label = np.array([0]*self.N + [1]*self.N)
+        self.model.fit(data, label, niter = 0)
+        self.model.save(f'{self.args.output_directory}psm_classifier/')
+        loaded = classifier(self.args).load(f'{self.args.output_directory}psm_classifier/')
+        with self.subTest('is the cutoff kept'):
+            self.assertEqual(loaded.cutoff, self.model.cutoff)
+        with self.subTest('are the predictions unchanged'):
+            self.assertTrue(np.array_equal(loaded.predict(data), self.model.predict(data)))
+    
     def test_preprocessor_works(self):
         class PSM:
             def __init__(self, rng, label):
@@ -122,6 +159,12 @@ class ClassifierTestSuite(base_test_classes.ParsedOptionsTestSuite):
         with self.subTest('make sure data work with classifier'):
             self.model.fit(processed_data, processed_labels)
             self.assertGreater(len(self.model.history['epochs']), 0)
+        with self.subTest('do the features match per PSM interpolation'):
+            for psm, features in zip(psms[::50], processed_data[::50], strict = True):
+                x = np.linspace(np.nanmin(psm.mz), np.nanmax(psm.mz), 256)
+                intensity = np.nan_to_num(psm.intensity/np.nanmax(psm.intensity))
+                interp_i = np.interp(x, psm.mz, intensity)
+                self.assertTrue(np.array_equal(features[:,0], interp_i/np.nansum(interp_i)))
 
     def test_winnowing_works(self):
         class PSM():
@@ -130,6 +173,7 @@ class ClassifierTestSuite(base_test_classes.ParsedOptionsTestSuite):
                 self.label = 'C[13]' if label != 0 else ''
                 self.is_labeled = bool(self.label)
                 self.idx = rng.random()
+                self.psm_metadata = {}
         
         ctrl = self.make_false_data(self.rng)
         obs = np.concatenate((self.make_false_data(self.rng),
@@ -157,6 +201,8 @@ class ClassifierTestSuite(base_test_classes.ParsedOptionsTestSuite):
             self.assertGreater(np.sum([l.value for l in filtered_labels])/self.N, 0.8)
         with self.subTest('are good and bad PSMs disjoint subsets?'):
             self.assertFalse(any(p.idx in good_idxs for p in bad_psms))
+        with self.subTest('are q-values added to the PSM metadata'):
+            self.assertTrue(all(p.psm_metadata['classifier_qvalue'] <= self.model.FDR for p in filtered_labels))
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,12 +7,18 @@ Created on Mon Jul 22 11:33:50 2024
 """
 
 import unittest
+import importlib.util
+import threading
 
 import numpy as np
+import pandas as pd
+from scipy.stats import betabinom, binom
 
 from isopacketModeler.data_generating_processes import BetabinomQuiescentMix, Betabinom, BinomQuiescentMix, Binom
-from isopacketModeler.fit_controller import peptide_fit_conroller, data_generating_processes
-from isopacketModeler.data_objects import peptide
+from isopacketModeler.data_generating_processes import binom_pmf, betabinom_pmf, background_matrix
+from isopacketModeler.fit_controller import peptide_fit_conroller, data_generating_processes, init_worker
+from isopacketModeler.data_objects import peptide, fit_data
+from isopacketModeler.report import ReportWriter, make_report
 import base_test_classes
 
 class BetabinomQuiescentMixTestSuite(base_test_classes.DataGeneratingProcessTestSuite):
@@ -51,6 +57,56 @@ class BinomTestSuite(base_test_classes.DataGeneratingProcessTestSuite):
         super().setUp()
         self.DGP = Binom(self.args)
 
+class ExpectedDistributionTestSuite(unittest.TestCase):
+    def test_pmfs_match_scipy(self):
+        for n in (1, 7, 40):
+            for p in (0, 0.3, 1):
+                with self.subTest('test binomial pmf'):
+                    self.assertTrue(np.allclose(binom_pmf(n, p), binom.pmf(range(n), n, p)))
+            for a, b in ((1, 1), (4, 3), (100, 2)):
+                with self.subTest('test betabinomial pmf'):
+                    self.assertTrue(np.allclose(betabinom_pmf(n, a, b), betabinom.pmf(range(n), n, a, b)))
+    
+    def test_background_matrix_convolves(self):
+        class mock_peptide():
+            def __init__(self, npeaks):
+                self.formula = {'C':20}
+                self.label_elm = 'C'
+                self.background = np.array([0.5, 0.3, 0.15, 0.05])
+                self.npeaks = npeaks
+        label = binom_pmf(20, 0.4)
+        for npeaks in (10, 23, 30):
+            pep = mock_peptide(npeaks)
+            conv = np.convolve(label, pep.background)
+            conv = np.concatenate((conv, np.zeros(max(0, npeaks - len(conv)))))[:npeaks]
+            with self.subTest(f'test convolution with {npeaks} peaks'):
+                self.assertTrue(np.allclose(background_matrix(pep) @ label, conv))
+
+class NestedModelTestSuite(base_test_classes.InitializedPSMsTestSuite):
+    def test_seeds_reproduce_nested_models(self):
+        rng = np.random.default_rng(1)
+        for psm in self.psms:
+            psm.intensity = rng.uniform(1e5,1e7,len(psm.mz))
+            ppm5 = (psm.mz[0]/1e6)*5
+            psm.mz_err = rng.uniform(-ppm5,ppm5,len(psm.mz))
+        pep = peptide(self.psms)
+        for DGP in [BetabinomQuiescentMix(self.args), BinomQuiescentMix(self.args)]:
+            nested = data_generating_processes[DGP.nested](self.args)
+            params = np.array(nested.get_x0(pep))
+            with self.subTest(f'does the {DGP.name} seed give the {nested.name} distribution'):
+                self.assertTrue(np.allclose(DGP.expected(pep, DGP.seed(params)), nested.expected(pep, params)))
+
+class SerialPool():
+    """Runs fitting tasks in this process and records the (peptide, model) pairs that were submitted."""
+    def __init__(self, args):
+        init_worker(threading.Event(), args)
+        self.submitted = []
+    
+    def apply_async(self, worker, args, callback, error_callback):
+        chunk, = args
+        self.submitted.extend((task[0], task[1]) for task in chunk)
+        callback(worker(chunk))
+
 class FitControllerTestSuite(base_test_classes.InitializedPSMsTestSuite):
     def setUp(self):
         super().setUp()
@@ -90,6 +146,107 @@ class FitControllerTestSuite(base_test_classes.InitializedPSMsTestSuite):
                 with self.subTest('werer the correct parameters recovered'):
                     self.assertAlmostEqual(truth, fitted, delta = 0.001)
     
+    def test_report_rows_are_written_during_fitting(self):
+        peptides = [self.make_peptide(BetabinomQuiescentMix(self.args), np.array([0.5,4,3])) for _ in range(3)]
+        writer = ReportWriter(self.args)
+        fit_controller = peptide_fit_conroller(self.args)
+        peptides = fit_controller.fit_peptides(peptides, writer = writer)
+        with self.subTest('are rows written before the report is finished'):
+            self.assertEqual(writer.rows, len(peptides))
+        make_report(self.args, peptides, writer)
+        report = pd.read_csv(writer.path, sep = '\t')
+        with self.subTest('is there one row per peptide'):
+            self.assertEqual(report.shape[0], len(peptides))
+        with self.subTest('are there columns for every model'):
+            for dgp in self.args.data_generating_processes:
+                self.assertIn(f'{dgp}_fit', report.columns)
+
+    def test_metadata_columns_do_not_depend_on_the_first_peptide(self):
+        self.args.psm_headers = self.args.psm_headers[:5] + ['Modifications', 'DeltaScore']
+        self.args.do_psm_classification = False
+        peptides = [self.make_peptide(Binom(self.args), np.array([0.5])) for _ in range(2)]
+        peptides = peptide_fit_conroller(self.args).fit_peptides(peptides, prune = False)
+        peptides[0].psm_metadata = [{'Modifications':np.nan, 'DeltaScore':0.5} for _ in peptides[0].psm_metadata]
+        peptides[1].psm_metadata = [{'Modifications':'M1(Oxidation)', 'DeltaScore':0.25} for _ in peptides[1].psm_metadata]
+        make_report(self.args, peptides)
+        report = pd.read_csv(f'{self.args.output_directory}peptides.tsv', sep = '\t')
+        with self.subTest('are the metadata columns named from the PSM file columns'):
+            self.assertEqual([c for c in report.columns if c.startswith('PSMs_')], 
+                             ['PSMs_unique_Modifications', 'PSMs_mean_DeltaScore'])
+        with self.subTest('are the later values kept'):
+            self.assertEqual(report['PSMs_unique_Modifications'][1], 'M1(Oxidation)')
+            self.assertEqual(list(report['PSMs_mean_DeltaScore']), [0.5, 0.25])
+    
+    def test_report_has_the_fit_fields(self):
+        pep, = peptide_fit_conroller(self.args).fit_peptides([self.make_peptide(Binom(self.args), np.array([0.5]))], prune = False)
+        make_report(self.args, [pep])
+        report = pd.read_csv(f'{self.args.output_directory}peptides.tsv', sep = '\t')
+        for column in ('npeaks', 'canonical_fit', 'canonical_nfev', 'canonical_success', 'Binom_nit', 'Binom_minimization_failures'):
+            with self.subTest(f'is {column} reported'):
+                self.assertIn(column, report.columns)
+        with self.subTest('are the optimizer fields filled in'):
+            self.assertTrue(report['Binom_success'].notna().all())
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow') is None, 'pyarrow is not installed')
+    def test_parquet_report_matches_tsv(self):
+        self.args.parquet_report = True
+        peptides = [self.make_peptide(BetabinomQuiescentMix(self.args), np.array([0.5,4,3])) for _ in range(3)]
+        writer = ReportWriter(self.args)
+        peptides = peptide_fit_conroller(self.args).fit_peptides(peptides, writer = writer)
+        make_report(self.args, peptides, writer)
+        tsv = pd.read_csv(writer.path, sep = '\t')
+        parquet = pd.read_parquet(writer.columnar.path)
+        with self.subTest('is there one row per peptide'):
+            self.assertEqual(parquet.shape[0], len(peptides))
+        with self.subTest('do the fit statistics match the tsv'):
+            for dgp in self.args.data_generating_processes:
+                self.assertTrue(np.allclose(tsv[f'{dgp}_fit'], parquet[f'{dgp}_fit'], equal_nan = True))
+        with self.subTest('are the peptide arrays stored'):
+            for obs, fitted_dist in zip(parquet['obs'], parquet['canonical_fitted_dist']):
+                self.assertEqual(len(np.stack(obs)[0]), len(fitted_dist))
+    
+    def test_chunks_cover_every_peptide(self):
+        self.args.cores = 2
+        fit_controller = peptide_fit_conroller(self.args)
+        peptides = [self.make_peptide(Binom(self.args), np.array([0.5])) for _ in range(10)]
+        for i, pep in enumerate(peptides):
+            pep.obs = pep.obs[:i%3 + 1]
+        tasks = [(i, DGP.name, fit_data(p), None) for i, p in enumerate(peptides) for DGP in fit_controller.DGPs]
+        chunks = fit_controller.chunks(tasks, sum(fit_controller.cost(t) for t in tasks)/8)
+        with self.subTest('is every task in exactly one chunk'):
+            self.assertEqual(sorted((i, name) for chunk in chunks for i, name, *_ in chunk), 
+                             sorted((i, name) for i, name, *_ in tasks))
+        with self.subTest('are the most expensive tasks dispatched first'):
+            costs = [fit_controller.cost(t) for chunk in chunks for t in chunk]
+            self.assertEqual(costs, sorted(costs, reverse = True))
+    
+    def test_good_fits_skip_remaining_models(self):
+        self.args.skip_models_below = 0.5
+        fit_controller = peptide_fit_conroller(self.args)
+        pep = self.make_peptide(Betabinom(self.args), np.array([4,3]))
+        pool = SerialPool(self.args)
+        _, fits = fit_controller.schedule(pool, [[pep]])
+        submitted = [name for _, name in pool.submitted]
+        with self.subTest('was the nested model never submitted'):
+            self.assertNotIn('BetabinomQuiescentMix', submitted)
+        with self.subTest('was the good model kept'):
+            self.assertIn('Betabinom', fits[0])
+        with self.subTest('was every submitted model fit'):
+            self.assertCountEqual(submitted, fits[0].keys())
+    
+    def test_nested_models_are_seeded_after_their_simpler_model(self):
+        fit_controller = peptide_fit_conroller(self.args)
+        pep = self.make_peptide(BetabinomQuiescentMix(self.args), np.array([0.5,4,3]))
+        pool = SerialPool(self.args)
+        _, fits = fit_controller.schedule(pool, [[pep]])
+        submitted = [name for _, name in pool.submitted]
+        with self.subTest('was every model fit once'):
+            self.assertCountEqual(submitted, self.args.data_generating_processes)
+        for DGP in fit_controller.DGPs:
+            if DGP.nested in fit_controller.models:
+                with self.subTest(f'was {DGP.name} submitted after {DGP.nested}'):
+                    self.assertLess(submitted.index(DGP.nested), submitted.index(DGP.name))
+    
     def test_model_selection_recovers_model(self):
         DGPs = ['BetabinomQuiescentMix',
                 'Betabinom',
@@ -100,24 +257,13 @@ class FitControllerTestSuite(base_test_classes.InitializedPSMsTestSuite):
                   np.array([0.5,0.5]),
                   np.array([0.5])]
         
-        class mock_event():
-            def is_set(self):
-                return False
-        event = mock_event()
         fit_controller = peptide_fit_conroller(self.args)
-        fit_controller.fit_all_DGPs.__globals__['event'] = event
-        
-        global all_peptides
         for DGP_name, param in zip(DGPs, params, strict = True):
             DGP = data_generating_processes[DGP_name](self.args)
-            pep = self.make_peptide(DGP, param)
-            all_peptides = [pep]
-            fit_controller.fit_all_DGPs.__globals__['all_peptides'] = all_peptides
-            pep.fit_results = fit_controller.fit_all_DGPs(0)
-            fit_controller.model_selection(pep)
+            pep, = fit_controller.fit_peptides([self.make_peptide(DGP, param)], prune = False)
             
-            with self.subTest(f'was the correct DGP chosen for {DGP.name}'):
-                self.assertEqual(pep.canonical_fit.dgp_name, DGP.name)
+            with self.subTest(f'does the canonical model reproduce {DGP.name}'):
+                self.assertTrue(np.allclose(pep.canonical_fit.fitted_dist, DGP.expected(pep, param), atol = 1e-3))
             with self.subTest(f'is the canonical fit good for {DGP.name}'):
                 self.assertLess(pep.canonical_fit.fit, 0.01)
             with self.subTest(f'is the correct model fit good for {DGP.name}'):
@@ -50,6 +50,13 @@ class optionsTestSuite(unittest.TestCase):
                     self.args.validate_inputs()
             setattr(self.args, attr, tmp)
     
+    def test_parallel_mzml_validation(self):
+        for value in (0, -1):
+            self.args.parallel_mzml = value
+            with self.subTest(msg = f'Testing parallel_mzml = {value}'):
+                with self.assertRaises(InputError):
+                    self.args.validate_inputs()
+    
     def test_mzml_identification(self):
         with self.subTest(msg = 'Testing mzml list length'):
             self.assertEqual(len(self.args.mzml_files), 2)
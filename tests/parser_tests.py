@@ -8,13 +8,17 @@ Created on Sat Jun 15 18:14:31 2024
 
 import unittest
 import warnings
+import os
+import shutil
+from unittest import mock
 
 from brainpy import isotopic_variants
 from sortedcontainers import SortedList
 import numpy as np
 
 import base_test_classes
-from isopacketModeler.parse_mzml import parse_PSMs, initialize_psms, process_psm, process_spectrum_data, read_mzml
+from isopacketModeler.parse_mzml import parse_PSMs, initialize_psms, process_psm, process_spectrum_data, read_mzml, needed_ms1s, MS1Cache
+from isopacketModeler.data_objects import match_peaks, Scan, ScanStore
 
 class parsePSMsTestSuite(base_test_classes.ParsedOptionsTestSuite):
     def test_parses_PD_psms_file(self):
@@ -55,6 +59,14 @@ class initializePSMsTestSuite(base_test_classes.InitializedPSMsTestSuite):
             with self.subTest('test formula is correct'):
                 self.assertEqual(ref_formula[elm], psms[0].formula[elm])
     
+    def test_PSMs_share_theoretical_packets(self):
+        psms = self.psms
+        with self.subTest('Check identical peptide ions share arrays'):
+            self.assertIs(psms[0].mz, psms[1].mz)
+            self.assertIs(psms[0].unenriched, psms[1].unenriched)
+        with self.subTest('Check different peptide ions do not share arrays'):
+            self.assertIsNot(psms[0].mz, psms[2].mz)
+    
     def test_control_PSMs_are_duplicated(self):
         psm_data = self.psm_data
         psm_data['file'] = ['test2.mzML']*self.N
@@ -90,21 +102,10 @@ class processPSMtestSuite(base_test_classes.InitializedPSMsTestSuite):
         mz = [p.mz for p in spectrum]
         intensity = [p.intensity for p in spectrum]
         #construct ms1 list
-        class mock_ms1():
-            def __init__(self):
-                self.i = intensity
-                self.mz = mz
-        ms1s = SortedList([(i, mock_ms1()) for i in range(20)])
-
-        def read_mzml(file):
-            return ms1s
-        
-        #inject our mocked data into the namespace of the function
-        process_psm.__globals__['read_mzml'] = read_mzml
-        process_psm.__globals__['PSM_list'] = PSM_list
+        ms1s = ScanStore.from_scans([Scan(i, mz, intensity) for i in range(20)])
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            results = process_psm('test1.mzML')
+            results = [r for r in (process_psm(psm, ms1s) for psm in PSM_list) if r is not None]
         with self.subTest('test that only one result is returned'):
             self.assertEqual(len(results), 1)
         with self.subTest('test that psm extracted enough peaks'):
@@ -125,21 +126,10 @@ class processPSMtestSuite(base_test_classes.InitializedPSMsTestSuite):
         mz += list(rng.uniform(0,100,N))
         intensity += list(rng.uniform(0,100,N))
         #construct ms1 list
-        class mock_ms1():
-            def __init__(self):
-                self.i = intensity
-                self.mz = mz
-        ms1s = SortedList([(i, mock_ms1()) for i in range(20)])
-
-        def read_mzml(file):
-            return ms1s
-        
-        #inject our mocked data into the namespace of the function
-        process_psm.__globals__['read_mzml'] = read_mzml
-        process_psm.__globals__['PSM_list'] = PSM_list
+        ms1s = ScanStore.from_scans([Scan(i, mz, intensity) for i in range(20)])
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            results = process_psm('test1.mzML')
+            results = [r for r in (process_psm(psm, ms1s) for psm in PSM_list) if r is not None]
         
         with self.subTest('test that the right number of peaks are extracted'):
             N_real_peaks = len([p for p in results[0].intensity if np.isfinite(p)])
@@ -166,21 +156,10 @@ class processPSMtestSuite(base_test_classes.InitializedPSMsTestSuite):
         mz += list(rng.uniform(0,100,N))
         intensity += list(rng.uniform(0,100,N))
         #construct ms1 list
-        class mock_ms1():
-            def __init__(self):
-                self.i = intensity
-                self.mz = mz
-        ms1s = SortedList([(i, mock_ms1()) for i in range(20)])
-
-        def read_mzml(file):
-            return ms1s
-        
-        #inject our mocked data into the namespace of the function
-        process_psm.__globals__['read_mzml'] = read_mzml
-        process_psm.__globals__['PSM_list'] = PSM_list
+        ms1s = ScanStore.from_scans([Scan(i, mz, intensity) for i in range(20)])
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            results = process_psm('test1.mzML')
+            results = [r for r in (process_psm(psm, ms1s) for psm in PSM_list) if r is not None]
         
         with self.subTest('test there are the right number of results'):
             self.assertEqual(len(results), 5)
@@ -204,18 +183,13 @@ class processSpectrumDataTestSuite(base_test_classes.InitializedPSMsTestSuite):
         mz += list(rng.uniform(0,100,N))
         intensity += list(rng.uniform(0,100,N))
         #construct ms1 list
-        class mock_ms1():
-            def __init__(self):
-                self.i = intensity
-                self.mz = mz
-        ms1s = SortedList([(i, mock_ms1()) for i in range(20)])
+        ms1s = ScanStore.from_scans([Scan(i, mz, intensity) for i in range(20)])
 
-        def read_mzml(file):
+        def read_mzml(file, psm_scans = None, cache_directory = None):
             return ms1s
         
         #inject our mocked data into the namespace of the function
         process_psm.__globals__['read_mzml'] = read_mzml
-        process_psm.__globals__['PSM_list'] = PSM_list
         process_spectrum_data.__globals__['process_psm'] = process_psm
         
         with warnings.catch_warnings():
@@ -229,5 +203,94 @@ class processSpectrumDataTestSuite(base_test_classes.InitializedPSMsTestSuite):
                 N_real_peaks = len([p for p in results[0].intensity if np.isfinite(p)])
                 self.assertEqual(N_real_peaks, len(good_peaks))
 
+class matchPeaksTestSuite(unittest.TestCase):
+    def test_match_peaks_agrees_with_sorted_list_search(self):
+        rng = np.random.default_rng(1)
+        class mock_ms1():
+            def __init__(self):
+                self.mz = np.round(rng.uniform(500, 510, 50), 3)
+                self.i = rng.uniform(0, 100, 50)
+        scans = [mock_ms1() for _ in range(7)]
+        targets = np.sort(np.concatenate((rng.uniform(499, 511, 20), scans[0].mz[:5])))
+        intensity, error = match_peaks(scans, targets)
+        with self.subTest('test that one row is returned per scan'):
+            self.assertEqual(intensity.shape, (len(scans), len(targets)))
+        for row, scan in enumerate(scans):
+            peaks = SortedList(zip(scan.mz, scan.i, strict = True))
+            for col, mz in enumerate(targets):
+                idx = max(1, peaks.bisect_left((mz,)))
+                closest = min(peaks[idx-1:idx+1], key = lambda x: abs(x[0] - mz))
+                if abs(closest[0] - mz) < (10/1e6)*mz:
+                    with self.subTest('test matched intensity is the closest peak'):
+                        self.assertEqual(intensity[row, col], closest[1])
+                    with self.subTest('test matched error is the m/z difference'):
+                        self.assertEqual(error[row, col], mz - closest[0])
+                else:
+                    with self.subTest('test unmatched targets are NaN'):
+                        self.assertTrue(np.isnan(intensity[row, col]) and np.isnan(error[row, col]))
+
+class neededMS1sTestSuite(unittest.TestCase):
+    def test_subset_neighbourhoods_match_full_neighbourhoods(self):
+        rng = np.random.default_rng(1)
+        ms1_scans = np.sort(rng.choice(range(1, 2000), 200, replace = False))
+        psm_scans = rng.integers(0, 2100, 15)
+        mz = [1.0]
+        full = ScanStore.from_scans([Scan(s, mz, mz) for s in ms1_scans])
+        subset = ScanStore.from_scans([Scan(s, mz, mz) for s in ms1_scans[needed_ms1s(ms1_scans, psm_scans)]])
+        with self.subTest('test that scans far from PSMs are skipped'):
+            self.assertLess(len(subset), len(full))
+        for scan in psm_scans:
+            with self.subTest('test that every PSM sees the same MS1 scans'):
+                self.assertListEqual([s.scan for s in subset.neighbourhood(scan)],
+                                     [s.scan for s in full.neighbourhood(scan)])
+
+class MS1CacheTestSuite(unittest.TestCase):
+    def setUp(self):
+        os.mkdir('cache_test')
+        self.mzml = 'cache_test/test.mzML'
+        with open(self.mzml, 'w') as mzml:
+            mzml.write('placeholder spectrum data')
+        self.cache = MS1Cache(self.mzml, 'cache_test/cache/')
+        self.store = ScanStore.from_scans([Scan(s, [100.0, 200.0], [1.0, 2.0]) for s in (1, 5, 9)])
+    
+    def tearDown(self):
+        shutil.rmtree('cache_test')
+    
+    def test_cache_round_trip(self):
+        self.cache.save(np.array([0, 4, 8]), np.array([1, 5, 9]), self.store)
+        ms1_idx, ms1_scans, store = self.cache.load()
+        with self.subTest('test that the MS1 index is restored'):
+            self.assertListEqual(list(ms1_scans), [1, 5, 9])
+        with self.subTest('test that the peaks are restored'):
+            self.assertListEqual(list(store.mz), list(self.store.mz))
+    
+    def test_cache_is_invalidated_by_changes(self):
+        self.cache.save(np.array([0, 4, 8]), np.array([1, 5, 9]), self.store)
+        with open(self.mzml, 'a') as mzml:
+            mzml.write('more spectra')
+        self.assertIsNone(self.cache.load())
+    
+    def test_files_with_the_same_name_do_not_share_entries(self):
+        self.cache.save(np.array([0, 4, 8]), np.array([1, 5, 9]), self.store)
+        os.mkdir('cache_test/other')
+        with open('cache_test/other/test.mzML', 'w') as mzml:
+            mzml.write('different spectrum data!')
+        other = MS1Cache('cache_test/other/test.mzML', 'cache_test/cache/')
+        with self.subTest('test that the entries are stored separately'):
+            self.assertNotEqual(other.path, self.cache.path)
+        with self.subTest('test that the other file has no entry'):
+            self.assertIsNone(other.load())
+    
+    def test_unchanged_files_are_hashed_once(self):
+        self.cache.save(np.array([0, 4, 8]), np.array([1, 5, 9]), self.store)
+        cache = MS1Cache(self.mzml, 'cache_test/cache/')
+        with mock.patch('isopacketModeler.parse_mzml.hashlib.blake2b') as blake2b:
+            cache.load()
+            cache.save(np.array([0, 4, 8]), np.array([1, 5, 9]), self.store)
+        with self.subTest('test that the stored hash is reused when the entry is rewritten'):
+            blake2b.assert_not_called()
+        with self.subTest('test that the rewritten entry is still valid'):
+            self.assertIsNotNone(MS1Cache(self.mzml, 'cache_test/cache/').load())
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,8 +6,11 @@ Created on Fri Jun 28 10:55:33 2024
 @author: 4vt
 """
 
+import numpy as np
+
 import base_test_classes
-from isopacketModeler.make_peptides import fingerprint, initialize_peptides
+from isopacketModeler.make_peptides import fingerprint, initialize_peptides, shard_peptides, shard_of
+from isopacketModeler.data_objects import PSMTable
 
 class MakePepetidesTestSuite(base_test_classes.ProcessedPSMsTestSuite):
     def test_nonsimilar_PSMs_arent_merged(self):
@@ -29,4 +32,39 @@ class MakePepetidesTestSuite(base_test_classes.ProcessedPSMsTestSuite):
             self.assertEqual(len(peptides), len(self.psms))
         with self.subTest('check that all psms were included as peptides'):
             self.assertCountEqual([p.raw_sequence for p in self.psms], [p.raw_sequence for p in peptides])
+
+    def test_shards_partition_peptides(self):
+        peptides = initialize_peptides(self.args, self.psms, [])
+        sharded = []
+        for i in range(1, 4):
+            self.args.shard = (i, 3)
+            sharded.extend(shard_peptides(self.args, peptides))
+        with self.subTest('is every peptide in exactly one shard'):
+            self.assertCountEqual([p.raw_sequence for p in sharded], [p.raw_sequence for p in peptides])
+        with self.subTest('is the shard of a fingerprint fixed'):
+            self.assertEqual(shard_of(('TEST', 'test1.mzML'), 7), 7)
     
+    def test_clean_filters_each_psm(self):
+        pep = initialize_peptides(self.args, self.psms, [])[0]
+        obs = np.array([[0.4, 0.3, np.nan, 0.1, np.nan, 0.05],
+                        [0.4, 0.1, 0.4, 0.1, np.nan, np.nan]])
+        cleaned = pep.clean(obs)
+        with self.subTest('are singletons removed'):
+            self.assertEqual(cleaned[0,3], 0)
+        with self.subTest('are points far above the trend removed'):
+            self.assertTrue(np.isnan(cleaned[1,2]))
+        with self.subTest('are rows cleaned independently'):
+            self.assertTrue(np.array_equal(cleaned[1], pep.clean(obs[1:])[0], equal_nan = True))
+        with self.subTest('are rows normalized'):
+            self.assertTrue(np.allclose(np.nansum(cleaned, axis = 1), 1))
+
+class PSMTableTestSuite(base_test_classes.ProcessedPSMsTestSuite):
+    def test_views_match_psms(self):
+        table = PSMTable.from_psms(self.psms)
+        with self.subTest('check the table length'):
+            self.assertEqual(len(table), len(self.psms))
+        for psm, view in zip(self.psms, table, strict = True):
+            with self.subTest('check scalar fields are kept'):
+                self.assertEqual(fingerprint(psm), fingerprint(view))
+            with self.subTest('check intensities are kept'):
+                self.assertTrue(np.array_equal(psm.intensity, view.intensity, equal_nan = True))
@@ -13,6 +13,7 @@ from parser_tests import *
 from peptide_tests import *
 from classifier_tests import *
 from fitting_tests import *
+from checkpoint_tests import *
 
 if __name__ == '__main__':
     unittest.main()